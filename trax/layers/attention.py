@@ -122,8 +122,13 @@ class PositionalEncoding(base.Layer):
 
 
 class AxialPositionalEncoding(base.Layer):
-  """Axial positional encoding."""
-  # TODO(kitaev): support variable-length sequences.
+  """Axial positional encoding.
+
+  Inputs may be shorter than the product of the axial shape, in which case the
+  encodings of the first positions are used. The encodings are computed for the
+  full (static) shape, so padding inputs to a few fixed lengths (e.g. with
+  bucketing in the input pipeline) compiles once per length.
+  """
 
   def __init__(self, shape=(64, 64, 3), d_embs=(384, 384, 256),
                kernel_initializer=init.RandomNormalInitializer(1.0),
@@ -162,9 +167,8 @@ class AxialPositionalEncoding(base.Layer):
       # emb = np.concatenate(embs, -1)
       # return inputs + np.reshape(emb, inputs.shape), state
       return inputs + np.concatenate(
-          [np.reshape(emb, inputs.shape[:-1] + (emb.shape[-1],))
-           for emb in embs
-          ], -1), state
+          [self._flatten_positions(emb, inputs.shape[1]) for emb in embs],
+          -1), state
     else:
       emb = np.concatenate(embs, -1)
       noise_shape = list(emb.shape)
@@ -177,7 +181,19 @@ class AxialPositionalEncoding(base.Layer):
       keep = math.random.bernoulli(rng, keep_prob, tuple(noise_shape))
       multiplier = keep.astype(inputs.dtype) / keep_prob
 
-      return inputs + np.reshape(emb * multiplier, inputs.shape), state
+      return inputs + self._flatten_positions(
+          emb * multiplier, inputs.shape[1]), state
+
+  def _flatten_positions(self, emb, length):
+    """Reshapes [batch, *shape, d] to [batch, length, d] (a prefix if short)."""
+    n_positions = int(onp.prod(self._shape))
+    if length > n_positions:
+      raise ValueError('Input length (%d) exceeds the number of axial positions '
+                       '(%d).' % (length, n_positions))
+    emb = np.reshape(emb, (emb.shape[0], n_positions, emb.shape[-1]))
+    if length < n_positions:
+      emb = emb[:, :length, :]
+    return emb
 
   def new_weights_and_state(self, input_signature):
     d_feature = input_signature.shape[-1]
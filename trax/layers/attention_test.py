@@ -22,6 +22,7 @@ from __future__ import print_function
 import numpy as onp
 from tensorflow import test
 from trax.layers import attention
+from trax.shapes import ShapeDtype
 
 
 class AttentionTest(test.TestCase):
@@ -62,6 +63,14 @@ class AttentionTest(test.TestCase):
                                     [6., 6.5, 7.]]]),
                         output_np)
 
+  def test_axial_positional_encoding_shorter_input(self):
+    layer = attention.AxialPositionalEncoding(shape=(2, 4), d_embs=(2, 2))
+    layer.init(ShapeDtype((1, 8, 4)))
+    full = onp.asarray(layer(onp.zeros((1, 8, 4), dtype=onp.float32)))
+    output_np = layer(onp.zeros((1, 5, 4), dtype=onp.float32))
+    self.assertEqual((1, 5, 4), output_np.shape)
+    self.assertAllClose(full[:, :5, :], output_np)
+
 
 if __name__ == '__main__':
   test.main()
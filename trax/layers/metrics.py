@@ -33,6 +33,9 @@ taking the weighted (and often also masked) mean of those values:
   - `CrossEntropyLoss`: weighted masked mean of pairwise cross entropy of
     (prediction_vector, target_vector)
 
+  - `NegLogProbLoss`: weighted masked mean of per-target negative
+    log-probabilities that the model computed itself
+
 
 TODO(jonni): Explain masks and weighting.
 """
@@ -66,6 +69,16 @@ def CrossEntropyLoss(id_to_mask=None, has_weights=False):
   return _WeightedMaskedMean(_CrossEntropy(), id_to_mask, has_weights)
 
 
+def NegLogProbLoss(id_to_mask=None, has_weights=False):
+  """Computes weighted masked mean of per-target negative log-probabilities.
+
+  Unlike CrossEntropyLoss, this takes the negative log-probability of each
+  target, e.g. from a model that fuses its output layer with the loss, instead
+  of log-probability vectors. The targets only determine the mask.
+  """
+  return _WeightedMaskedMean(_NegLogProb(), id_to_mask, has_weights)
+
+
 def SumOfWeights(id_to_mask=None, has_weights=False):
   """Returns a layer to compute sum of weights of all non-masked elements."""
   multiply_by_weights = cb.Multiply() if has_weights else []
@@ -101,6 +114,13 @@ def _CrossEntropy(inputs, **unused_kwargs):
                        axis=-1)
 
 
+@base.layer(n_in=2, n_out=1)
+def _NegLogProb(inputs, **unused_kwargs):
+  """Returns the given negative log-probabilities, ignoring the targets."""
+  neg_log_prob, _ = inputs
+  return neg_log_prob
+
+
 @base.layer()
 def _ElementMask(target, id_to_mask=0, **unused_kwargs):
   """Returns a mask with zeros marking elements to exclude from calculations."""
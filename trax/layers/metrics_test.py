@@ -73,6 +73,24 @@ class MetricsLayerTest(absltest.TestCase):
         metrics.CrossEntropyLoss(), input_signature)
     self.assertEqual(result_shape, ())
 
+  def test_neg_log_prob_loss_matches_cross_entropy_loss(self):
+    log_probs = onp.log(onp.random.dirichlet(onp.ones(5), size=(3, 4)))
+    log_probs = log_probs.astype(onp.float32)
+    targets = onp.random.randint(5, size=(3, 4))
+    targets[:, 3:] = 0
+    weights = onp.random.uniform(size=(3, 4)).astype(onp.float32)
+    neg_log_probs = -onp.take_along_axis(
+        log_probs, targets[..., None], -1)[..., 0]
+    cross_entropy = metrics.CrossEntropyLoss(id_to_mask=0, has_weights=True)
+    neg_log_prob = metrics.NegLogProbLoss(id_to_mask=0, has_weights=True)
+    cross_entropy.init(
+        (signature(log_probs), signature(targets), signature(weights)))
+    neg_log_prob.init(
+        (signature(neg_log_probs), signature(targets), signature(weights)))
+    onp.testing.assert_allclose(
+        neg_log_prob((neg_log_probs, targets, weights)),
+        cross_entropy((log_probs, targets, weights)), rtol=1e-5)
+
   def test_accuracy_scalar(self):
     input_signature = (ShapeDtype((29, 4, 4, 20)), ShapeDtype((29, 4, 4)))
     result_shape = base.check_shape_agreement(
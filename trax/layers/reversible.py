@@ -27,6 +27,7 @@ from trax.layers import combinators as cb
 # pylint: disable=protected-access
 _inputs_from_stack = cb._inputs_from_stack
 _outputs_onto_stack = cb._outputs_onto_stack
+_pop_rng_and_split = cb._pop_rng_and_split
 # pylint: enable=protected-access
 
 
@@ -83,11 +84,23 @@ class ReversibleLayer(base.Layer):
 class ReversibleSwap(ReversibleLayer, cb.Swap):
   """Swap the first two element on the stack."""
 
+  @property
+  def has_backward(self):
+    # A swap is a pure permutation of the stack, so there is nothing to gain
+    # from wrapping it in custom gradients; let it trace to no ops at all.
+    return False
+
   def reverse(self, output, weights=(), state=(), new_state=(), **kwargs):
     # Swap is its own inverse, except that reverse doesn't return the state.
     return self.forward_with_state(output, weights=weights, state=state,
                                    **kwargs)[0]
 
+  def reverse_and_grad(self, output, ct, weights=(), state=(), new_state=(),
+                       **kwargs):
+    # Cotangents are permuted exactly like the activations; no vjp is needed.
+    del weights, state, new_state, kwargs
+    return (output[1], output[0]), ((ct[1], ct[0]), ())
+
 
 class ReversibleSerial(ReversibleLayer, cb.Serial):
   """A reversible version of tl.Serial (requires reversible sub-layers)."""
@@ -103,10 +116,7 @@ class ReversibleSerial(ReversibleLayer, cb.Serial):
                 i, layer))
 
   def reverse(self, output, weights=(), state=(), new_state=(), **kwargs):
-    rng = kwargs.pop('rng', None)
-    rngs = (None,) * self._n_layers
-    if rng is not None:
-      rngs = math.random.split(rng, self._n_layers)
+    rngs = _pop_rng_and_split(kwargs, self._n_layers)
 
     stack = output
     for layer, p, s, ns, rng in reversed(list(zip(
@@ -120,10 +130,7 @@ class ReversibleSerial(ReversibleLayer, cb.Serial):
 
   def reverse_and_grad(self, output, ct, weights=(), state=(), new_state=(),
                        **kwargs):
-    rng = kwargs.pop('rng', None)
-    rngs = (None,) * self._n_layers
-    if rng is not None:
-      rngs = math.random.split(rng, self._n_layers)
+    rngs = _pop_rng_and_split(kwargs, self._n_layers)
 
     stack = output
     stack_ct = ct
@@ -142,3 +149,207 @@ class ReversibleSerial(ReversibleLayer, cb.Serial):
           layer, layer_ct, stack_ct, layer.n_out, layer.n_in)
 
     return stack, (stack_ct, weights_ct)
+
+
+class ScannedReversibleSerial(ReversibleLayer):
+  """Applies n_layers copies of a reversible block with a single scan.
+
+  This is equivalent to ReversibleSerial([block_fn() for _ in range(n_layers)])
+  when all copies have the same structure and shapes, but the weights and
+  state of the copies are stacked along a new leading axis and the layers are
+  run by scanning one block over that axis. As a result only one copy of the
+  block is traced and compiled, independently of n_layers, and buffers are
+  reused across layers in both the forward and the reverse direction.
+  """
+
+  def __init__(self, block_fn, n_layers):
+    """Creates the scanned stack.
+
+    Args:
+      block_fn: function with no arguments that returns a new reversible layer
+        (or list of reversible layers) for one block; its inputs and outputs
+        must match in number, shape and dtype.
+      n_layers: int: number of blocks to stack.
+    """
+    block = block_fn()
+    if isinstance(block, (list, tuple)):
+      block = ReversibleSerial(block)
+    if not isinstance(block, ReversibleLayer):
+      raise ValueError(
+          'Block of ScannedReversibleSerial is not reversible: {}'.format(
+              block))
+    if block.n_in != block.n_out:
+      raise ValueError(
+          'Block of ScannedReversibleSerial must have n_in ({}) equal to '
+          'n_out ({}).'.format(block.n_in, block.n_out))
+    super(ScannedReversibleSerial, self).__init__(
+        n_in=block.n_in, n_out=block.n_out)
+    self._block_fn = block_fn
+    self._sublayers = (block,)
+    self._n_scanned_layers = n_layers
+
+  @property
+  def sublayer(self):
+    """Returns the block that is scanned over the stacked weights."""
+    return self._sublayers[0]
+
+  def forward_with_state(self, inputs, weights=base.EMPTY_WEIGHTS,
+                         state=base.EMPTY_STATE, **kwargs):
+    rngs = self._split_rngs(kwargs)
+    def scannable_fn(layer_args, stack):  # pylint: disable=invalid-name
+      w, s, rng = layer_args
+      stack, new_s = self.sublayer.forward_with_state(
+          stack, weights=w, state=s, rng=rng, **kwargs)
+      return new_s, stack
+    new_state, outputs = math.scan(scannable_fn, (weights, state, rngs),
+                                   inputs)
+    return outputs, new_state
+
+  def reverse(self, output, weights=(), state=(), new_state=(), **kwargs):
+    rngs = self._split_rngs(kwargs)
+    def scannable_fn(layer_args, stack):  # pylint: disable=invalid-name
+      w, s, ns, rng = layer_args
+      stack = self.sublayer.reverse(stack, w, s, ns, rng=rng, **kwargs)
+      return (), stack
+    layer_args = _reverse_layers((weights, state, new_state, rngs))
+    _, inputs = math.scan(scannable_fn, layer_args, output)
+    return inputs
+
+  def reverse_and_grad(self, output, ct, weights=(), state=(), new_state=(),
+                       **kwargs):
+    rngs = self._split_rngs(kwargs)
+    def scannable_fn(layer_args, stack_and_ct):  # pylint: disable=invalid-name
+      w, s, ns, rng = layer_args
+      stack, stack_ct = stack_and_ct
+      stack, (stack_ct, w_ct) = self.sublayer.reverse_and_grad(
+          stack, stack_ct, w, s, ns, rng=rng, **kwargs)
+      return w_ct, (stack, stack_ct)
+    layer_args = _reverse_layers((weights, state, new_state, rngs))
+    weights_ct, (inputs, inputs_ct) = math.scan(
+        scannable_fn, layer_args, (output, ct))
+    return inputs, (inputs_ct, _reverse_layers(weights_ct))
+
+  def new_weights_and_state(self, input_signature):
+    if self._init_finished:
+      # Weights are only created on the first init (see Layer.init).
+      return base.EMPTY_WEIGHTS, self.state
+    # Every layer needs its own initialization, so we init fresh copies of the
+    # block (and drop them right away) before stacking their weights and state.
+    blocks = [self.sublayer] + [
+        self._block_fn() for _ in range(self._n_scanned_layers - 1)]
+    weights, states = [], []
+    for block, rng in zip(blocks, self.new_rngs(self._n_scanned_layers)):
+      if isinstance(block, (list, tuple)):
+        block = ReversibleSerial(block)
+      block_weights, block_state = block.init(input_signature, rng=rng)
+      weights.append(block_weights)
+      states.append(block_state)
+    return _stack_layers(weights), _stack_layers(states)
+
+  def _split_rngs(self, kwargs):
+    # Always scan over one rng per layer: blocks without weights or state give
+    # the scan nothing else to iterate over. Like Layer.__call__, fall back to a
+    # fixed key if no rng is given.
+    rng = kwargs.pop('rng', None)
+    if rng is None:
+      rng = math.random.get_prng(0)
+    return math.numpy.stack(
+        math.random.split(rng, self._n_scanned_layers))
+
+
+class CheckpointedScannedSerial(ScannedReversibleSerial):
+  """Stacked copies of a block with O(sqrt(n_layers)) checkpointed activations.
+
+  Instead of reconstructing activations by reversing the layers, the stacked
+  layers are split into n_groups groups and run as a scan over groups of scans
+  over layers, both re-materialized. The backward pass then only keeps the
+  activations at group boundaries plus those inside the group currently being
+  recomputed, i.e. O(n_groups + n_layers / n_groups) snapshots, at the cost of
+  one extra forward pass. The blocks are differentiated with plain autodiff
+  (their reversible sublayers do not reconstruct inputs from outputs), so this
+  does not rely on exact reversibility; it still implements reverse when used
+  inside a ReversibleSerial.
+  """
+
+  def __init__(self, block_fn, n_layers, n_groups=None):
+    """Creates the checkpointed stack.
+
+    Args:
+      block_fn: function with no arguments that returns a new reversible layer
+        (or list of reversible layers) for one block; its inputs and outputs
+        must match in number, shape and dtype.
+      n_layers: int: number of blocks to stack.
+      n_groups: int (optional): number of checkpointed groups; must divide
+        n_layers. Defaults to the divisor of n_layers closest to (and not above)
+        sqrt(n_layers).
+    """
+    super(CheckpointedScannedSerial, self).__init__(block_fn, n_layers)
+    if n_groups is None:
+      n_groups = max(d for d in range(1, int(n_layers ** 0.5) + 1)
+                     if n_layers % d == 0)
+    if n_layers % n_groups != 0:
+      raise ValueError('n_groups ({}) must divide n_layers ({}).'.format(
+          n_groups, n_layers))
+    self._n_groups = n_groups
+
+  @property
+  def has_backward(self):
+    return False
+
+  def forward_with_state(self, inputs, weights=base.EMPTY_WEIGHTS,
+                         state=base.EMPTY_STATE, **kwargs):
+    rngs = self._split_rngs(kwargs)
+    n_groups = self._n_groups
+    group_size = self._n_scanned_layers // n_groups
+
+    def group(x):
+      return math.numpy.reshape(x, (n_groups, group_size) + x.shape[1:])
+    def ungroup(x):
+      return math.numpy.reshape(x, (n_groups * group_size,) + x.shape[2:])
+
+    def layer_fn(layer_args, stack):  # pylint: disable=invalid-name
+      w, s, rng = layer_args
+      stack, new_s = _forward_with_autodiff(self.sublayer, stack, w, s, rng)
+      return new_s, stack
+    def group_fn(group_args, stack):  # pylint: disable=invalid-name
+      return math.scan(layer_fn, group_args, stack, remat=True)
+
+    group_args = jax.tree_util.tree_map(group, (weights, state, rngs))
+    new_state, outputs = math.scan(group_fn, group_args, inputs, remat=True)
+    return outputs, jax.tree_util.tree_map(ungroup, new_state)
+
+
+def _forward_with_autodiff(layer, inputs, weights, state, rng):
+  """Runs layer forward so that reversible sublayers use plain autodiff.
+
+  Serial combinators (which include ReversibleSerial and reversible residual
+  layers) are unrolled here instead of being called through _forward_internal,
+  so none of them is differentiated by reconstructing its inputs from its
+  outputs in reverse_and_grad. Other layers run their forward_with_state.
+  """
+  if weights is base.EMPTY_WEIGHTS:  # pylint: disable=literal-comparison
+    weights = layer.weights
+  if not isinstance(layer, cb.Serial) or not layer.sublayers:
+    return layer.forward_with_state(
+        inputs, weights=weights, state=state, rng=rng)
+  # Split the rng exactly like Serial.forward_with_state does.
+  rngs = _pop_rng_and_split({'rng': rng}, len(layer.sublayers))
+  stack = inputs
+  new_state = []
+  for sublayer, w, s, r in zip(layer.sublayers, weights, state, rngs):
+    sublayer_inputs = _inputs_from_stack(sublayer, stack)
+    outputs, s = _forward_with_autodiff(sublayer, sublayer_inputs, w, s, r)
+    stack = _outputs_onto_stack(sublayer, outputs, stack)
+    new_state.append(s)
+  return stack, new_state
+
+
+def _stack_layers(trees):
+  """Stacks identically structured trees along a new leading layers axis."""
+  return jax.tree_util.tree_multimap(
+      lambda *xs: math.numpy.stack(xs), *trees)
+
+
+def _reverse_layers(tree):
+  """Reverses the leading layers axis of all arrays in tree."""
+  return jax.tree_util.tree_map(lambda x: x[::-1], tree)
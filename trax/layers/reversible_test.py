@@ -20,6 +20,7 @@ from __future__ import division
 from __future__ import print_function
 
 from absl.testing import absltest
+import numpy as onp
 from trax.layers import base
 from trax.layers import reversible
 from trax.shapes import ShapeDtype
@@ -33,6 +34,33 @@ class ReversibleLayerTest(absltest.TestCase):
     final_shape = base.check_shape_agreement(layer, input_signature)
     self.assertEqual(final_shape, ((3, 3), (2, 3)))
 
+  def test_reversible_swap_reverse_and_grad(self):
+    layer = reversible.ReversibleSwap()
+    x, ct = layer.reverse_and_grad(('y0', 'y1'), ('g0', 'g1'))
+    self.assertEqual(x, ('y1', 'y0'))
+    self.assertEqual(ct, (('g1', 'g0'), ()))
+
+  def test_scanned_reversible_serial(self):
+    layer = reversible.ScannedReversibleSerial(reversible.ReversibleSwap, 3)
+    input_signature = (ShapeDtype((2, 3)), ShapeDtype((2, 3)))
+    final_shape = base.check_shape_agreement(layer, input_signature)
+    self.assertEqual(final_shape, ((2, 3), (2, 3)))
+
+  def test_scanned_reversible_serial_without_rng(self):
+    layer = reversible.ScannedReversibleSerial(reversible.ReversibleSwap, 3)
+    input_signature = (ShapeDtype((2, 3)), ShapeDtype((2, 3)))
+    weights, state = layer.init(input_signature)
+    x = (onp.zeros((2, 3), onp.float32), onp.ones((2, 3), onp.float32))
+    y, new_state = layer.forward_with_state(x, weights, state)
+    onp.testing.assert_array_equal(y[0], x[1])
+    onp.testing.assert_array_equal(y[1], x[0])
+    reversed_x = layer.reverse(y, weights, state, new_state)
+    grad_x, (x_ct, _) = layer.reverse_and_grad(
+        y, y, weights, state, new_state)
+    for actual, expected in zip(
+        tuple(reversed_x) + tuple(grad_x) + tuple(x_ct), x + x + x):
+      onp.testing.assert_array_equal(actual, expected)
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -18,20 +18,88 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
+
 import jax
+import numpy as onp
 
 from trax import layers as tl
+from trax import math
 from trax.layers.combinators import _pop_rng_and_split
 from trax.math import numpy as np
 from trax.math import random
 from trax.models import transformer
+from trax.shapes import ShapeDtype
 
 
 # Layers are always CamelCase, but functions in general are snake_case
 # pylint: disable=invalid-name
 
 
-class Map(tl.Layer):
+class _Wrapper(tl.Layer):
+  """Base class for layers that run a single wrapped layer.
+
+  As in tl.Scan, the wrapped layer is this layer's only sublayer and its weights
+  and state are this layer's weights and state. Subclasses can override
+  _wrapped_signature if the wrapped layer sees a differently shaped input.
+  """
+
+  def __init__(self, layer, n_in=None, n_out=None):
+    if isinstance(layer, (list, tuple)):
+      layer = tl.Serial(layer)
+    super(_Wrapper, self).__init__(
+        n_in=layer.n_in if n_in is None else n_in,
+        n_out=layer.n_out if n_out is None else n_out)
+    self._sublayers = [layer]
+
+  @property
+  def sublayer(self):
+    """Returns the unique sublayer managed by this layer."""
+    return self._sublayers[0]
+
+  def new_weights_and_state(self, input_signature):
+    # Layer.init only seeds direct sublayers of the layer it is called on, so
+    # pass an rng along for when this layer is itself nested.
+    return self.sublayer.init(self._wrapped_signature(input_signature),
+                              rng=self.new_rng())
+
+  @tl.Layer.weights.setter
+  def weights(self, weights):
+    """Sets weights on this layer and its sublayer, like tl.Serial."""
+    if weights is tl.EMPTY_WEIGHTS:  # pylint: disable=literal-comparison
+      return
+    self._weights = self.sublayer.weights = weights
+
+  @tl.Layer.state.setter
+  def state(self, state):
+    """Sets state on this layer and its sublayer, like tl.Serial."""
+    self._state = self.sublayer.state = state
+
+  def _set_input_signature_recursive(self, input_signature):
+    self._input_signature = input_signature
+    self.sublayer._set_input_signature_recursive(  # pylint: disable=protected-access
+        self._wrapped_signature(input_signature))
+
+  def _wrapped_signature(self, input_signature):
+    return input_signature
+
+  def _wrapped_weights(self, weights):
+    # Empty weights mean that the sublayer is shared and holds weights that
+    # were initialized elsewhere.
+    if weights is tl.EMPTY_WEIGHTS:  # pylint: disable=literal-comparison
+      return self.sublayer.weights
+    return weights
+
+  def _forward_wrapped(self, x, weights, state, rng):
+    """Runs the sublayer without caching weights or state on it."""
+    weights = self._wrapped_weights(weights)
+    if self.sublayer.has_backward:
+      return self.sublayer._do_custom_gradients(x, weights, state, rng=rng)  # pylint: disable=protected-access
+    return self.sublayer.forward_with_state(
+        x, weights=weights, state=state, rng=rng)
+
+
+class Map(_Wrapper):
   """Combinator for applying a layer to a list or tuple."""
 
   def __init__(self, layer, n_sections=1, check_shapes=True):
@@ -45,52 +113,65 @@ class Map(tl.Layer):
     Returns:
       A new layer representing mapping layer to all elements of the input.
     """
-    super(Map, self).__init__(n_in=n_sections, n_out=n_sections)
-    if layer is None or isinstance(layer, (list, tuple)):
+    if layer is None:
       layer = tl.Serial(layer)
-    self._layer = layer
+    super(Map, self).__init__(layer, n_in=n_sections, n_out=n_sections)
     # Generally a Map should be applied to lists where all elements have
-    # the same shape -- because self._layer will only be initialized once
+    # the same shape -- because self.sublayer will only be initialized once
     # and it could have different parameters for different shapes. But there
-    # are valid cases -- e.g., when self._layer has no parameters -- where we
+    # are valid cases -- e.g., when self.sublayer has no parameters -- where we
     # can apply Map to different shapes -- set check_shapes=False in such cases.
     self._check_shapes = check_shapes
     self._n_sections = n_sections
 
   def forward_with_state(self, inputs, weights=(), state=(), **kwargs):
     if self._n_sections == 1:
-      results = self._layer(inputs, weights=weights, state=state, **kwargs)
-    else:
-      rngs = _pop_rng_and_split(kwargs, len(inputs))
-      results = [self._layer(x, weights=weights, state=state, rng=r, **kwargs)
-                 for x, r in zip(inputs, rngs)]
-      results = tuple(results)
+      return self._apply(inputs, weights, state, kwargs.get('rng'))
+    rngs = _pop_rng_and_split(kwargs, len(inputs))
+    if self._check_shapes and rngs[0] is not None:
+      # All sections have the same shape, so run them as a single batch.
+      def apply_to_section(x, rng):
+        return self._apply(x, weights, state, rng)
+      results, new_state = jax.vmap(apply_to_section)(
+          np.stack(inputs), np.stack(rngs))
+      results = tuple(jax.tree_util.tree_map(lambda y: y[i], results)  # pylint: disable=cell-var-from-loop
+                      for i in range(len(inputs)))
+      # Like the unbatched case below, keep the state of the last section.
+      new_state = jax.tree_util.tree_map(lambda s: s[-1], new_state)
+      # Sublayers of a combinator cache their state while being traced under
+      # vmap; overwrite those values so that no vmap tracer outlives this call.
+      self.sublayer.state = new_state
+      return results, new_state
+    # Every section starts from the same state, and the returned state is the
+    # one from the last section.
     # TODO(kitaev): think about how to merge state across copies in the map.
-    return results, self._layer.state
+    results = []
+    new_state = state
+    for x, rng in zip(inputs, rngs):
+      y, new_state = self._apply(x, weights, state, rng)
+      results.append(y)
+    return tuple(results), new_state
+
+  def _apply(self, x, weights, state, rng):
+    # Like Layer.__call__, fall back to a fixed key if no rng is given.
+    if rng is None:
+      rng = random.get_prng(0)
+    return self._forward_wrapped(x, weights, state, rng)
 
   def new_weights_and_state(self, input_signature):
-    if self._n_sections == 1:
-      return self._layer.init(input_signature)
-    first_shape = input_signature[0].shape
-    if self._check_shapes:
+    if self._n_sections > 1 and self._check_shapes:
+      first_shape = input_signature[0].shape
       for shape_dtype in input_signature:
         if shape_dtype.shape != first_shape:
           raise ValueError('Map layer can only be applied to list of elements '
                            'with the same shapes. This shape %s vs first shape '
                            '%s.' % (str(shape_dtype.shape), str(first_shape)))
-    return self._layer.init(input_signature[0])
-
-  @tl.Layer.weights.setter
-  def weights(self, weights):
-    self._weights = self._layer.weights = weights
-
-  @tl.Layer.state.setter
-  def state(self, state):
-    self._state = self._layer.state = state
+    return super(Map, self).new_weights_and_state(input_signature)
 
-  def _set_input_signature_recursive(self, input_signature):
-    self._input_signature = input_signature
-    self._layer._set_input_signature_recursive(input_signature)  # pylint: disable=protected-access
+  def _wrapped_signature(self, input_signature):
+    if self._n_sections == 1:
+      return input_signature
+    return input_signature[0]
 
 
 class BroadcastedDropout(tl.Layer):
@@ -101,7 +182,7 @@ class BroadcastedDropout(tl.Layer):
     self._rate = rate
     if self._rate >= 1.0:
       raise ValueError('Dropout rate (%f) must be lower than 1.' % rate)
-    self._broadcast_dims = broadcast_dims
+    self._broadcast_dims = tuple(broadcast_dims)
     self._mode = mode
 
   def forward_with_state(self, x, weights, state, rng):
@@ -110,17 +191,184 @@ class BroadcastedDropout(tl.Layer):
     if rng is None:
       raise ValueError('BroadcastedDropout requires rng kwarg.')
     if self._mode == 'train' and self._rate > 0.0:
-      noise_shape = list(x.shape)
-      for dim in self._broadcast_dims:
-        noise_shape[dim] = 1
-      keep_prob = jax.lax.tie_in(rng, 1.0 - self._rate)
-      keep = random.bernoulli(rng, keep_prob, tuple(noise_shape))
-      multiplier = keep.astype(x.dtype) / jax.lax.tie_in(keep, keep_prob)
-      return x * multiplier, state
+      noise_axes = [dim % len(x.shape) for dim in self._broadcast_dims]
+      noise_shape = tuple(1 if i in noise_axes else d
+                          for i, d in enumerate(x.shape))
+      return _broadcasted_dropout(
+          x, rng, 1.0 - self._rate, noise_shape), state
     else:
       return x, state
 
 
+@functools.partial(jax.jit, static_argnums=(2, 3))
+def _broadcasted_dropout(x, rng, keep_prob, noise_shape):
+  """Drops out x with a mask of noise_shape broadcast over x.
+
+  The mask is never materialized as a separate boolean/float tensor: uniform
+  noise is compared against keep_prob inside the select, so XLA can fuse mask
+  generation, broadcasting and scaling into a single elementwise kernel. The
+  noise is drawn in float32 whatever the dtype of x, so that the keep rate
+  matches keep_prob exactly for low-precision activations too.
+
+  Args:
+    x: the activations to drop out.
+    rng: PRNG key for the dropout noise.
+    keep_prob: float (static): probability of keeping each element.
+    noise_shape: tuple of ints (static): shape of the noise, broadcastable to
+      x.shape.
+
+  Returns:
+    x with dropped elements zeroed and kept elements scaled by 1 / keep_prob.
+  """
+  u = random.uniform(rng, noise_shape)
+  scale = np.asarray(1.0 / keep_prob, dtype=x.dtype)
+  return np.where(u < keep_prob, x * scale, np.zeros((), dtype=x.dtype))
+
+
+class LowPrecisionPositionalEncoding(tl.PositionalEncoding):
+  """PositionalEncoding whose table is stored in a lower-precision dtype.
+
+  The table is kept in dtype (bfloat16 by default) and cast to the dtype of
+  the inputs when it is added to them, which halves the memory read for the
+  table compared to float32.
+  """
+
+  def __init__(self, max_len=2048, dropout=0.0, dropout_broadcast_dims=(-2,),
+               mode='train', dtype=None):
+    super(LowPrecisionPositionalEncoding, self).__init__(
+        max_len=max_len, dropout=dropout,
+        dropout_broadcast_dims=dropout_broadcast_dims, mode=mode)
+    self._dtype = dtype
+
+  def forward_with_state(self, inputs, weights=tl.EMPTY_WEIGHTS,
+                         state=tl.EMPTY_STATE, rng=None, **kwargs):
+    return super(LowPrecisionPositionalEncoding, self).forward_with_state(
+        inputs, weights.astype(inputs.dtype), state, rng, **kwargs)
+
+  def new_weights_and_state(self, input_signature):
+    weights, state = super(
+        LowPrecisionPositionalEncoding, self).new_weights_and_state(
+            input_signature)
+    dtype = np.bfloat16 if self._dtype is None else self._dtype
+    return weights.astype(dtype), state
+
+
+class FusedEmbedPosDropout(tl.Layer):
+  """Embedding plus sinusoidal positional encoding, with a single dropout.
+
+  The table lookup and the position add are computed in one layer, so no
+  intermediate [batch, length, d_model] tensors are kept between the two steps.
+  Without dropout this computes the same as Embedding followed by
+  PositionalEncoding. With dropout it does not: a single broadcasted dropout is
+  applied to the sum, whereas ReformerLM's unfused embedder drops out the
+  embeddings and (inside PositionalEncoding) the position table separately.
+  Weights are stored as (embeddings, positions).
+  """
+
+  def __init__(self, vocab_size, d_model, max_len=2048, dropout=0.0,
+               mode='train',
+               kernel_initializer=tl.RandomNormalInitializer(1.0)):
+    super(FusedEmbedPosDropout, self).__init__()
+    self._vocab_size = vocab_size
+    self._d_model = d_model
+    self._mode = mode
+    self._kernel_initializer = kernel_initializer
+    self._positional_encoding = tl.PositionalEncoding(
+        max_len=max_len, mode=mode)
+    self._dropout = BroadcastedDropout(rate=dropout, mode=mode)  # pylint: disable=no-value-for-parameter
+
+  def forward_with_state(self, x, weights, state, rng):
+    embeddings, positions = weights
+    x = np.take(embeddings, x, axis=0)
+    if self._mode == 'predict':
+      # As in PositionalEncoding, state holds the index of the current position.
+      return x + np.expand_dims(positions[:, state, :], 1), state + 1
+    x = x + positions[:, :x.shape[1], :]
+    return self._dropout.forward_with_state(x, (), state, rng)
+
+  def new_weights_and_state(self, input_signature):
+    del input_signature
+    embeddings = self._kernel_initializer(
+        (self._vocab_size, self._d_model), self.new_rng())
+    positions, state = self._positional_encoding.new_weights_and_state(
+        ShapeDtype((1, 1, self._d_model)))
+    return (embeddings, positions), state
+
+
+class Int8Embedding(tl.Layer):
+  """Embedding whose table is stored as int8 with one float16 scale per row.
+
+  Gathered rows are dequantized to float32 on the fly, so the table takes a
+  quarter of the memory of a float32 Embedding. Integer weights have no
+  gradient, so this layer is for inference only; a trained float table can be
+  converted with quantize_embedding.
+  """
+
+  def __init__(self,
+               d_feature,
+               vocab_size,
+               kernel_initializer=tl.RandomNormalInitializer(1.0)):
+    super(Int8Embedding, self).__init__()
+    self._d_feature = d_feature
+    self._vocab_size = vocab_size
+    self._kernel_initializer = kernel_initializer
+
+  def forward(self, x, weights):
+    table, scales = weights
+    rows = np.take(table, x, axis=0).astype(np.float32)
+    return rows * np.take(scales, x, axis=0).astype(np.float32)
+
+  def new_weights(self, input_signature):
+    del input_signature
+    table = self._kernel_initializer(
+        (self._vocab_size, self._d_feature), self.new_rng())
+    return quantize_embedding(table)
+
+
+def quantize_embedding(table):
+  """Converts a float [vocab, d] table to Int8Embedding's (table, scales)."""
+  scales = np.max(np.abs(table), axis=-1, keepdims=True) / 127.0
+  scales = np.maximum(scales, onp.finfo(onp.float16).tiny)
+  quantized = np.round(table / scales).astype(np.int8)
+  return quantized, scales.astype(np.float16)
+
+
+class ShiftedEmbedding(_Wrapper):
+  """Embeds tokens shifted right by one position along the length axis.
+
+  Equivalent to ShiftRight followed by the given Embedding layer: the first
+  position gets the embedding of the padding token 0 and the rest are gathered
+  from tokens[:, :-1], so the shifted token sequence is never materialized.
+  The Embedding layer is wrapped rather than copied, so its weights can be
+  shared with other places in the model that use the same layer.
+  """
+
+  def forward(self, x, weights):
+    weights = self._wrapped_weights(weights)
+    first = self.sublayer.forward(np.zeros_like(x[:, :1]), weights)
+    rest = self.sublayer.forward(x[:, :-1], weights)
+    return np.concatenate([first, rest], axis=1)
+
+
+class EmbedAndMask(_Wrapper):
+  """Embeds tokens and computes their padding mask in one layer.
+
+  Equivalent to tl.Branch(embedder, tl.PaddingMask(pad)), but both outputs are
+  computed from a single read of the tokens. The embedder is wrapped rather
+  than copied, so its layers can be shared with other parts of the model.
+  """
+
+  def __init__(self, embedder, pad=0):
+    super(EmbedAndMask, self).__init__(embedder, n_out=2)
+    self._pad = pad
+
+  def forward_with_state(self, x, weights=(), state=(), **kwargs):
+    embedded, state = self._forward_wrapped(
+        x, weights, state, kwargs.get('rng'))
+    mask = np.reshape(x != self._pad, (x.shape[0], 1, 1, x.shape[-1]))
+    return (embedded, mask), state
+
+
 def FeedForward(d_model, d_ff, dropout, activation, mode):
   """Feed-forward block with layer normalization at start."""
   return [
@@ -133,24 +381,269 @@ def FeedForward(d_model, d_ff, dropout, activation, mode):
   ]
 
 
-def ChunkedFeedForward(d_model, d_ff, dropout, activation, chunk_size, mode):
-  """Chunked feed-forward block with layer normalization at start."""
-  ff = FeedForward(d_model, d_ff, dropout, activation, mode)
-  if chunk_size < 1:
-    return ff
-  def reshape_to_chunks(x):
-    batch_times_length = x.shape[0] * x.shape[1]
-    assert batch_times_length % chunk_size == 0
-    n_chunks = batch_times_length // chunk_size
-    return np.reshape(x, [n_chunks, 1, chunk_size] + list(x.shape[2:]))
+def GatedFeedForward(d_model, d_ff, dropout, activation, mode):
+  """Gated (GLU-style) feed-forward block with layer normalization at start.
+
+  Computes Dense(d_model)(activation(x W_1) * (x W_3)). The W_1 and W_3
+  projections are stored side by side in a single Dense(2 * d_ff), so both are
+  computed by one matmul whose output is split in half.
+  """
   return [
-      tl.Dup(),  # Just to have shape for later after scan.
-      tl.Fn(reshape_to_chunks, n_out=1),
-      tl.Scan(tl.Serial(ff), axis=0, n_carry=0, remat=True),
-      tl.Fn(lambda x, y: np.reshape(x, y.shape))
+      tl.LayerNorm(),
+      tl.Dense(2 * d_ff),
+      tl.Split(n_items=2, axis=-1),
+      tl.Parallel(activation(), []),
+      tl.Multiply(),
+      BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
+      tl.Dense(d_model),
+      BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
   ]
 
 
+class TiledFeedForward(tl.Layer):
+  """Dense(d_ff), dropout, activation, Dense(d_model) tiled along d_ff.
+
+  The hidden layer is computed in n_tiles slices of depth d_ff // n_tiles and
+  each slice is immediately accumulated into the output projection, so the full
+  d_ff-deep hidden activations are never materialized. Slices are recomputed on
+  the backward pass. The activation must be a layer without weights.
+  """
+
+  def __init__(self, d_model, d_ff, dropout, activation, n_tiles=1,
+               mode='train',
+               kernel_initializer=tl.GlorotUniformInitializer(),
+               bias_initializer=tl.RandomNormalInitializer(1e-6)):
+    super(TiledFeedForward, self).__init__()
+    if d_ff % n_tiles != 0:
+      raise ValueError('d_ff (%d) must be divisible by n_tiles (%d).' % (
+          d_ff, n_tiles))
+    self._d_model = d_model
+    self._d_ff = d_ff
+    self._n_tiles = n_tiles
+    self._dropout = BroadcastedDropout(rate=dropout, mode=mode)  # pylint: disable=no-value-for-parameter
+    self._activation = activation()
+    self._kernel_initializer = kernel_initializer
+    self._bias_initializer = bias_initializer
+
+  def forward_with_state(self, x, weights, state, rng):
+    if rng is None:
+      raise ValueError('TiledFeedForward requires rng kwarg.')
+    w1, b1, w2, b2 = weights
+    n_tiles = self._n_tiles
+    d_tile = self._d_ff // n_tiles
+    # Expose the tiles as a leading axis to scan over:
+    # [d_in, d_ff] -> [n_tiles, d_in, d_tile] and
+    # [d_ff, d_model] -> [n_tiles, d_tile, d_model].
+    w1 = np.transpose(np.reshape(w1, (w1.shape[0], n_tiles, d_tile)), (1, 0, 2))
+    b1 = np.reshape(b1, (n_tiles, d_tile))
+    w2 = np.reshape(w2, (n_tiles, d_tile, self._d_model))
+    rngs = np.stack(random.split(rng, n_tiles))
+
+    def accumulate_tile(tile, z):
+      tile_w1, tile_b1, tile_w2, tile_rng = tile
+      h = np.dot(x, tile_w1) + tile_b1
+      h, _ = self._dropout.forward_with_state(h, (), (), tile_rng)
+      h = self._activation.forward(h, ())
+      return (), z + np.dot(h, tile_w2)
+
+    z = np.zeros(x.shape[:-1] + (self._d_model,), dtype=x.dtype)
+    _, z = math.scan(accumulate_tile, (w1, b1, w2, rngs), z, remat=True)
+    return z + b2, state
+
+  def new_weights(self, input_signature):
+    input_shape = input_signature.shape
+    rng1, rng2, rng3, rng4 = self.new_rngs(4)
+    w1 = self._kernel_initializer((input_shape[-1], self._d_ff), rng1)
+    b1 = self._bias_initializer((self._d_ff,), rng2)
+    w2 = self._kernel_initializer((self._d_ff, self._d_model), rng3)
+    b2 = self._bias_initializer((self._d_model,), rng4)
+    return (w1, b1, w2, b2)
+
+
+def ChunkedFeedForward(d_model, d_ff, dropout, activation, chunk_size, mode,
+                       n_tiles=1, compute_dtype=None):
+  """Chunked feed-forward block with layer normalization at start.
+
+  If chunk_size > 0, the block is applied to chunk_size positions at a time. If
+  n_tiles > 1 as well, the hidden layer of each chunk is further split into
+  n_tiles slices along d_ff (see TiledFeedForward); its weights are then stored
+  as a flat (w1, b1, w2, b2) instead of as two Dense layers. If compute_dtype
+  is set, the matmuls after the layer normalization run in that dtype (see
+  MixedPrecision).
+  """
+  mixed = _mixed_precision_fn(compute_dtype)
+  if chunk_size > 0 and n_tiles > 1:
+    ff = [
+        tl.LayerNorm(),
+        mixed(TiledFeedForward(d_model, d_ff, dropout, activation,
+                               n_tiles=n_tiles, mode=mode)),
+        BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
+    ]
+  else:
+    ff = FeedForward(d_model, d_ff, dropout, activation, mode)
+    ff = [ff[0], mixed(ff[1:])]  # Keep LayerNorm in float32.
+  if chunk_size < 1:
+    return ff
+  return ApplyInChunks(ff, chunk_size)
+
+
+class ApplyInChunks(_Wrapper):
+  """Applies a layer to chunks of chunk_size positions at a time.
+
+  The batch and length axes of the input are folded into chunks of chunk_size
+  positions and the layer is scanned over the chunks (with re-materialization,
+  unless remat is False). Each chunk gets its own rng, split from the rng of
+  this layer, so e.g. dropout masks differ between chunks. The shape to restore
+  after the scan is taken from the input at trace time, so no copy of the input
+  needs to stay alive across the scan.
+  """
+
+  def __init__(self, layer, chunk_size, remat=True):
+    super(ApplyInChunks, self).__init__(tl.Serial(layer))
+    self._chunk_size = chunk_size
+    self._remat = remat
+
+  def forward_with_state(self, x, weights=(), state=(), **kwargs):
+    chunks = np.reshape(x, self._chunked_shape(x.shape))
+    rng = kwargs.get('rng')
+    # Like Layer.__call__, fall back to a fixed key if no rng is given.
+    if rng is None:
+      rng = random.get_prng(0)
+    rngs = random.split(rng, chunks.shape[0])
+    weights = self._wrapped_weights(weights)
+
+    def apply_to_chunk(chunk_and_rng, state):
+      chunk, chunk_rng = chunk_and_rng
+      return self._forward_wrapped(chunk, weights, state, chunk_rng)
+
+    res, state = math.scan(
+        apply_to_chunk, (chunks, rngs), state, remat=self._remat)
+    return np.reshape(res, x.shape), state
+
+  def _wrapped_signature(self, input_signature):
+    # The wrapped layer sees one chunk at a time.
+    return ShapeDtype(self._chunked_shape(input_signature.shape)[1:],
+                      input_signature.dtype)
+
+  def _chunked_shape(self, shape):
+    batch_times_length = shape[0] * shape[1]
+    assert batch_times_length % self._chunk_size == 0
+    n_chunks = batch_times_length // self._chunk_size
+    return (n_chunks, 1, self._chunk_size) + tuple(shape[2:])
+
+
+class TiledLogSoftmaxDense(tl.Layer):
+  """Dense(vocab_size) followed by LogSoftmax, computed in tiles.
+
+  The positions (all axes but the last) are split into n_tiles tiles and the
+  output projection and log-normalization are computed one tile at a time. Only
+  the log-probabilities of the current tile are live inside the computation,
+  and each tile is re-materialized on the backward pass, so the temporaries of
+  the full [..., vocab_size] logits are never resident at once.
+  """
+
+  def __init__(self, vocab_size, n_tiles=1,
+               kernel_initializer=tl.GlorotUniformInitializer(),
+               bias_initializer=tl.RandomNormalInitializer(1e-6)):
+    super(TiledLogSoftmaxDense, self).__init__()
+    self._vocab_size = vocab_size
+    self._n_tiles = n_tiles
+    self._kernel_initializer = kernel_initializer
+    self._bias_initializer = bias_initializer
+
+  def forward(self, x, weights):
+    w, b = weights
+
+    def log_softmax_dense(x_tile, carry):
+      logits = np.dot(x_tile, w) + b
+      return logits - math.logsumexp(logits, -1, keepdims=True), carry
+
+    if self._n_tiles == 1:
+      # A single tile needs neither the scan nor its re-materialization.
+      return log_softmax_dense(x, ())[0]
+
+    n_positions = int(onp.prod(x.shape[:-1]))
+    if n_positions % self._n_tiles != 0:
+      raise ValueError('Number of positions (%d) must be divisible by n_tiles '
+                       '(%d).' % (n_positions, self._n_tiles))
+    # Tiling the flattened positions is a free reshape (no transposes).
+    tiles = np.reshape(
+        x, (self._n_tiles, n_positions // self._n_tiles, x.shape[-1]))
+    res, _ = math.scan(log_softmax_dense, tiles, (), remat=True)
+    return np.reshape(res, x.shape[:-1] + (self._vocab_size,))
+
+  def new_weights(self, input_signature):
+    input_shape = input_signature.shape
+    rng1, rng2 = self.new_rngs(2)
+    w = self._kernel_initializer((input_shape[-1], self._vocab_size), rng1)
+    b = self._bias_initializer((self._vocab_size,), rng2)
+    return (w, b)
+
+
+class TiledLogSoftmaxCrossEntropy(tl.Layer):
+  """Per-position cross-entropy of Dense(vocab_size) followed by LogSoftmax.
+
+  Maps (activations, targets) to the negative log-probability of each target.
+  The vocab is split into n_tiles tiles, and the log-normalizer is accumulated
+  one tile at a time with a running maximum (an online logsumexp), so only one
+  tile of logits is live at once and the [..., vocab_size] log-probabilities are
+  never materialized. Weights have the same layout as TiledLogSoftmaxDense.
+  This is the training head of Reformer(fused_loss=True).
+  """
+
+  def __init__(self, vocab_size, n_tiles=1,
+               kernel_initializer=tl.GlorotUniformInitializer(),
+               bias_initializer=tl.RandomNormalInitializer(1e-6)):
+    super(TiledLogSoftmaxCrossEntropy, self).__init__(n_in=2)
+    if vocab_size % n_tiles != 0:
+      raise ValueError('vocab_size (%d) must be divisible by n_tiles (%d).' % (
+          vocab_size, n_tiles))
+    self._vocab_size = vocab_size
+    self._n_tiles = n_tiles
+    self._kernel_initializer = kernel_initializer
+    self._bias_initializer = bias_initializer
+
+  def forward(self, inputs, weights):
+    x, targets = inputs
+    w, b = weights
+    tile_size = self._vocab_size // self._n_tiles
+
+    def accumulate_tile(tile, carry):
+      w_tile, b_tile, start = tile
+      running_max, running_sum, target_logits = carry
+      logits = np.dot(x, w_tile) + b_tile
+      new_max = np.maximum(running_max, np.max(logits, axis=-1))
+      running_sum = (running_sum * np.exp(running_max - new_max) +
+                     np.sum(np.exp(logits - new_max[..., None]), axis=-1))
+      # Targets outside of this tile match no column and add zero.
+      is_target = (np.arange(tile_size) == (targets - start)[..., None])
+      target_logits += np.sum(np.where(is_target, logits, 0.0), axis=-1)
+      return (), (new_max, running_sum, target_logits)
+
+    init = (np.full(targets.shape, -np.inf, dtype=x.dtype),
+            np.zeros(targets.shape, dtype=x.dtype),
+            np.zeros(targets.shape, dtype=x.dtype))
+    if self._n_tiles == 1:
+      # A single tile needs neither the scan nor its re-materialization.
+      _, (running_max, running_sum, target_logits) = accumulate_tile(
+          (w, b, 0), init)
+    else:
+      w_tiles = np.transpose(
+          np.reshape(w, (w.shape[0], self._n_tiles, tile_size)), (1, 0, 2))
+      b_tiles = np.reshape(b, (self._n_tiles, tile_size))
+      starts = np.arange(self._n_tiles) * tile_size
+      _, (running_max, running_sum, target_logits) = math.scan(
+          accumulate_tile, (w_tiles, b_tiles, starts), init, remat=True)
+    return running_max + np.log(running_sum) - target_logits
+
+  def new_weights(self, input_signature):
+    input_shape = input_signature[0].shape
+    rng1, rng2 = self.new_rngs(2)
+    w = self._kernel_initializer((input_shape[-1], self._vocab_size), rng1)
+    b = self._bias_initializer((self._vocab_size,), rng2)
+    return (w, b)
+
+
 class SplitForOutput(tl.ReversibleLayer):
   """Splits activations into sections (for use right before the output layer).
 
@@ -174,37 +667,64 @@ class SplitForOutput(tl.ReversibleLayer):
   def forward(self, inputs, weights):
     del weights
     x1, x2 = inputs
+    axis = self._axis % len(x1.shape)
 
-    x1_split = np.split(x1, self._n_sections, self._axis)
-    x2_split = np.split(x2, self._n_sections, self._axis)
+    # Expose the sections as a new axis (a free reshape) so that a single
+    # concatenate produces all of the outputs at once.
+    def expose_sections(x):
+      return np.reshape(x, x.shape[:axis] + (
+          self._n_sections, x.shape[axis] // self._n_sections,
+          ) + x.shape[axis + 1:])
+    res = np.concatenate([expose_sections(x1), expose_sections(x2)], -1)
 
-    res = [np.concatenate(ys, -1) for ys in zip(x1_split, x2_split)]
-    return tuple(res)
+    section_index = (slice(None),) * axis
+    return tuple(res[section_index + (i,)] for i in range(self._n_sections))
 
   def reverse(self, output, weights=(), state=(), new_state=(), **kwargs):
     del weights, kwargs
-
-    x1_split = []
-    x2_split = []
-    for y in output:
-      y1, y2 = np.split(y, 2, -1)
-      x1_split.append(y1)
-      x2_split.append(y2)
-
-    x1 = np.concatenate(x1_split, self._axis)
-    x2 = np.concatenate(x2_split, self._axis)
-
-    return (x1, x2)
+    return self._merge_sections(output)
 
   def reverse_and_grad(self, output, ct, weights=(), state=(), new_state=(),
                        **kwargs):
     del weights, kwargs
-    return self.reverse(output), (self.reverse(ct), ())
+    # The cotangents go through the same rearrangement as the outputs. Merging
+    # them separately avoids stacking (i.e., copying) both full tensors.
+    return self._merge_sections(output), (self._merge_sections(ct), ())
+
+  def _as_tuple(self, sections):
+    if not isinstance(sections, (list, tuple)):
+      return (sections,)
+    return tuple(sections)
+
+  def _merge_sections(self, sections):
+    sections = self._as_tuple(sections)
+    axis = self._axis % len(sections[0].shape)
+
+    # Mirror of forward: one stack, one split, and a reshape to merge sections.
+    res = np.stack(sections, axis)
+    x1, x2 = np.split(res, 2, -1)
+
+    def merge_sections(x):
+      return np.reshape(x, x.shape[:axis] + (
+          x.shape[axis] * x.shape[axis + 1],) + x.shape[axis + 2:])
+    return (merge_sections(x1), merge_sections(x2))
 
 
 @tl.layer()
 def Chunk(x, weights, n_sections=2, **kwargs):
   del weights, kwargs
+  return _chunk(x, n_sections)
+
+
+@tl.layer()
+def Unchunk(x, weights, n_sections=2, **kwargs):
+  del weights, kwargs
+  return _unchunk(x, n_sections)
+
+
+def _chunk(x, n_sections):
+  if n_sections == 1:
+    return x
   assert x.shape[1] % n_sections == 0
   return np.reshape(x, (
       x.shape[0] * n_sections,
@@ -212,9 +732,9 @@ def Chunk(x, weights, n_sections=2, **kwargs):
       ) + x.shape[2:])
 
 
-@tl.layer()
-def Unchunk(x, weights, n_sections=2, **kwargs):
-  del weights, kwargs
+def _unchunk(x, n_sections):
+  if n_sections == 1:
+    return x
   assert x.shape[0] % n_sections == 0
   return np.reshape(x, (
       x.shape[0] // n_sections,
@@ -222,6 +742,206 @@ def Unchunk(x, weights, n_sections=2, **kwargs):
       ) + x.shape[2:])
 
 
+class ChunkedLayerNorm(tl.Layer):
+  """LayerNorm followed by Chunk, normalizing in the unchunked layout.
+
+  Chunking only splits the length axis, so the normalized feature axis is the
+  same before and after; normalizing first leaves the reshape as the last,
+  metadata-only op.
+  """
+
+  def __init__(self, n_sections=2):
+    super(ChunkedLayerNorm, self).__init__()
+    self._n_sections = n_sections
+    self._layer_norm = tl.LayerNorm()
+
+  def forward(self, x, weights):
+    return _chunk(self._layer_norm.forward(x, weights), self._n_sections)
+
+  def new_weights(self, input_signature):
+    return self._layer_norm.new_weights(input_signature)
+
+
+class UnchunkDropout(tl.Layer):
+  """Unchunk followed by BroadcastedDropout, as a single layer."""
+
+  def __init__(self, n_sections=2, rate=0.0, mode='train'):
+    super(UnchunkDropout, self).__init__()
+    self._n_sections = n_sections
+    self._dropout = BroadcastedDropout(rate=rate, mode=mode)  # pylint: disable=no-value-for-parameter
+
+  def forward_with_state(self, x, weights, state, rng):
+    return self._dropout.forward_with_state(
+        _unchunk(x, self._n_sections), weights, state, rng)
+
+
+@tl.layer(n_in=3, n_out=2)
+def ApplyResidual(xs, weights, subtract=False, **kwargs):
+  """Maps (x2, x1_or_y1, residual) to (x1_or_y1 +/- residual, x2)."""
+  del weights, kwargs
+  x2, x1_or_y1, residual = xs
+  if subtract:
+    return x1_or_y1 - residual, x2
+  return x1_or_y1 + residual, x2
+
+
+@tl.layer(n_in=2, n_out=3)
+def MaskAndDup(xs, weights, **kwargs):
+  """Maps (x, padding_mask) to (x, x, encoder-decoder mask).
+
+  Equivalent to tl.Branch([], tl.EncoderDecoderMask()) followed by tl.Dup(),
+  as a single layer.
+  """
+  del weights, kwargs
+  x, padding_mask = xs
+  padding_mask = np.reshape(
+      padding_mask, (padding_mask.shape[0], 1, 1, padding_mask.shape[-1]))
+  # Final mask shape is [batch, 1 for heads, decoder-len, encoder-len].
+  return x, x, padding_mask + np.zeros((1, 1, x.shape[1], 1))
+
+
+class MixedPrecision(_Wrapper):
+  """Runs a layer in compute_dtype, keeping its weights in their own dtype.
+
+  Floating-point inputs and weights are cast to compute_dtype on the way in
+  and outputs are cast to float32 on the way out, so the wrapped layer's
+  matmuls run in e.g. bfloat16 while the (master) weights, their gradients and
+  the surrounding activations stay in float32.
+  """
+
+  def __init__(self, layer, compute_dtype):
+    super(MixedPrecision, self).__init__(layer)
+    self._compute_dtype = compute_dtype
+
+  def forward_with_state(self, inputs, weights=(), state=(), **kwargs):
+    inputs, weights = _cast_floating(
+        (inputs, self._wrapped_weights(weights)), self._compute_dtype)
+    outputs, state = self._forward_wrapped(
+        inputs, weights, state, kwargs.get('rng'))
+    return _cast_floating(outputs, onp.float32), state
+
+
+class Remat(_Wrapper):
+  """Runs a layer under jax.remat, recomputing its activations for backprop.
+
+  Only the inputs of the wrapped layer are kept for the backward pass; its
+  intermediate activations are recomputed from them instead of being stored.
+  """
+
+  def forward_with_state(self, inputs, weights=(), state=(), **kwargs):
+    rng = kwargs.get('rng')
+    # Like Layer.__call__, fall back to a fixed key if no rng is given.
+    if rng is None:
+      rng = random.get_prng(0)
+    outputs, new_state = jax.remat(self._forward_wrapped)(
+        inputs, self._wrapped_weights(weights), state, rng)
+    # Sublayers of a combinator cache their state while being traced under
+    # remat; overwrite those values so that no tracer outlives this call.
+    self.sublayer.state = new_state
+    return outputs, new_state
+
+
+def _cast_floating(tree, dtype):
+  """Casts the floating-point arrays in tree to dtype."""
+  def cast(x):
+    if np.issubdtype(x.dtype, np.floating):
+      return x.astype(dtype)
+    return x
+  return jax.tree_util.tree_map(cast, tree)
+
+
+class LayerNormQKV(tl.Layer):
+  """LayerNorm followed by a single projection to queries, keys and values.
+
+  Equivalent to LayerNorm and three Dense(d_feature) layers applied to copies of
+  the normalized input (or, with n_heads set, three bias-free
+  ComputeAttentionHeads), but with one [d_model, 3 * d_feature] matmul whose
+  output is split three ways. If compute_dtype is set, the matmul runs in that
+  dtype while the normalization and the outputs keep the dtype of the input.
+  """
+
+  def __init__(self, d_feature, n_heads=None, use_bias=True,
+               compute_dtype=None,
+               kernel_initializer=tl.GlorotUniformInitializer(),
+               bias_initializer=tl.RandomNormalInitializer(1e-6)):
+    super(LayerNormQKV, self).__init__(n_out=3)
+    self._d_feature = d_feature
+    self._n_heads = n_heads
+    self._use_bias = use_bias
+    self._compute_dtype = compute_dtype
+    self._kernel_initializer = kernel_initializer
+    self._bias_initializer = bias_initializer
+    self._layer_norm = tl.LayerNorm()
+
+  def forward(self, x, weights):
+    norm_weights, w, b = weights
+    normalized = self._layer_norm.forward(x, norm_weights)
+    if self._compute_dtype is not None:
+      normalized, w, b = _cast_floating(
+          (normalized, w, b), self._compute_dtype)
+    qkv = np.dot(normalized, w)
+    if self._use_bias:
+      qkv = qkv + b
+    q, k, v = np.split(qkv.astype(x.dtype), 3, axis=-1)
+    if self._n_heads is None:
+      return q, k, v
+    return tuple(_split_heads(y, self._n_heads) for y in (q, k, v))
+
+  def new_weights(self, input_signature):
+    w, b = _new_fused_dense_weights(
+        self.new_rngs(6), input_signature.shape[-1], self._d_feature,
+        self._kernel_initializer,
+        self._bias_initializer if self._use_bias else None)
+    return self._layer_norm.new_weights(input_signature), w, b
+
+
+class ProjectKV(tl.Layer):
+  """Projects one input to keys and values with a single matmul.
+
+  Equivalent to two Dense(d_feature) layers applied to copies of the input, as
+  in the key and value projections of tl.AttentionQKV.
+  """
+
+  def __init__(self, d_feature,
+               kernel_initializer=tl.GlorotUniformInitializer(),
+               bias_initializer=tl.RandomNormalInitializer(1e-6)):
+    super(ProjectKV, self).__init__(n_out=2)
+    self._d_feature = d_feature
+    self._kernel_initializer = kernel_initializer
+    self._bias_initializer = bias_initializer
+
+  def forward(self, x, weights):
+    w, b = weights
+    k, v = np.split(np.dot(x, w) + b, 2, axis=-1)
+    return k, v
+
+  def new_weights(self, input_signature):
+    return _new_fused_dense_weights(
+        self.new_rngs(4), input_signature.shape[-1], self._d_feature,
+        self._kernel_initializer, self._bias_initializer)
+
+
+def _new_fused_dense_weights(rngs, d_in, d_feature, kernel_initializer,
+                             bias_initializer=None):
+  """Initializes one Dense(d_feature) per pair of rngs and concatenates them."""
+  n_parts = len(rngs) // 2
+  w = np.concatenate([kernel_initializer((d_in, d_feature), rng)
+                      for rng in rngs[:n_parts]], axis=-1)
+  if bias_initializer is None:
+    return w, ()
+  b = np.concatenate([bias_initializer((d_feature,), rng)
+                      for rng in rngs[n_parts:]], axis=-1)
+  return w, b
+
+
+def _split_heads(x, n_heads):
+  """Reshapes [batch, length, d] to [batch * n_heads, length, d // n_heads]."""
+  batch, length, d_feature = x.shape
+  x = np.reshape(x, (batch, length, n_heads, d_feature // n_heads))
+  x = np.transpose(x, (0, 2, 1, 3))
+  return np.reshape(x, (batch * n_heads, length, d_feature // n_heads))
+
+
 class ReversibleHalfResidual(tl.ReversibleLayer, tl.Serial):
   """Half of a RevNet-style residual (only updates part of the hidden state)."""
 
@@ -230,27 +950,26 @@ class ReversibleHalfResidual(tl.ReversibleLayer, tl.Serial):
         tl.Parallel([], tl.Dup()),             # x1_or_y1, x2, x2,       ...
         tl.Swap(),                             # x2, x1_or_y1, x2,       ...
         tl.Parallel([], [], residual_layers),  # x2, x1_or_y1, residual, ...
-        tl.Select([2, 1, 0]),                  # residual, x1_or_y1, x2, ...
     )
 
     self.n_preserve = self.compute_residual.n_out - 2
-    parallel_preserve = [[]] * self.n_preserve
 
+    # ApplyResidual also puts the updated half back on top of the stack, so no
+    # separate permutation of the stack is needed.
     layers = [
         self.compute_residual,
-        tl.Parallel(tl.Add(), *parallel_preserve)
+        ApplyResidual(),  # pylint: disable=no-value-for-parameter
     ]
     super(ReversibleHalfResidual, self).__init__(layers)
 
-    self.subtract_top = tl.Parallel(tl.SubtractTop(), *parallel_preserve)
+    self.subtract_top = ApplyResidual(subtract=True)  # pylint: disable=no-value-for-parameter
     self.reverse_layers = [self.compute_residual, self.subtract_top]
 
   def reverse(self, output, weights=(), state=(), new_state=(), **kwargs):
     reconstructed_x = output
-    rng = kwargs.pop('rng', None)
-    rngs = (None,) * self._n_layers
-    if rng is not None:
-      rngs = random.split(rng, self._n_layers)
+    # The rng is split once per call, before the loop, exactly as in forward.
+    # The loop runs over two different layers, so it is unrolled, not scanned.
+    rngs = _pop_rng_and_split(kwargs, self._n_layers)
     # Note that self.sublayers aligns exactly with self.reverse_layers in
     # terms of parameter and rng usage, so no re-ordering is required.
     for layer, p, s, ns, rng in zip(
@@ -261,26 +980,37 @@ class ReversibleHalfResidual(tl.ReversibleLayer, tl.Serial):
 
   def reverse_and_grad(self, output, ct, weights=(), state=(), new_state=(),
                        **kwargs):
-    rng = kwargs.pop('rng', None)
-    rngs = (None,) * self._n_layers
-    if rng is not None:
-      rngs = random.split(rng, self._n_layers)
-
-    def call_compute_residual(x, weights):
-      res = self.compute_residual(x, weights=weights, state=state[0],
+    rngs = _pop_rng_and_split(kwargs, self._n_layers)
+
+    # Masks and other non-float inputs are closed over rather than passed to
+    # jax.vjp, which only accepts inputs it can differentiate.
+    diff_idx = [i for i, x in enumerate(output)
+                if np.issubdtype(x.dtype, np.inexact)]
+
+    def call_compute_residual(diff_x, weights):
+      x = list(output)
+      for i, xi in zip(diff_idx, diff_x):
+        x[i] = xi
+      res = self.compute_residual(tuple(x), weights=weights, state=state[0],
                                   rng=rngs[0], **kwargs)
       return res
 
     assert len(ct) == self.n_preserve + 1
-    ct = (ct[0], ct[0]) + ct[1:]
+    # Cotangents for (x2, x1_or_y1, residual, ...).
+    residual_ct = (ct[1], ct[0], ct[0]) + tuple(ct[2:])
 
     stack_with_residual, vjpfun = jax.vjp(
-        call_compute_residual, output, weights[0])
+        call_compute_residual, tuple(output[i] for i in diff_idx), weights[0])
     reconstructed_x = self.subtract_top(
         stack_with_residual, weights=weights[-1], state=state[-1], rng=rngs[-1],
         **kwargs)
 
-    x_ct, residual_weights_ct = vjpfun(ct)
+    diff_x_ct, residual_weights_ct = vjpfun(residual_ct)
+    # Non-float inputs pass through unchanged, so they keep their cotangents.
+    x_ct = list(ct)
+    for i, xi_ct in zip(diff_idx, diff_x_ct):
+      x_ct[i] = xi_ct
+    x_ct = tuple(x_ct)
     assert not jax.tree_util.tree_leaves(weights[-1])
     add_top_weights_ct = weights[-1]
     return reconstructed_x, (x_ct, [residual_weights_ct, add_top_weights_ct])
@@ -294,6 +1024,21 @@ class ApplyAttentionWrapper(tl.Parallel):
     super(ApplyAttentionWrapper, self).__init__(attention, [], [])
     self.attention = attention
 
+  def forward_with_state(self, inputs, weights=(), state=(), **kwargs):
+    # Only the attention has weights, state or randomness, so the pass-through
+    # inputs skip tl.Parallel's per-sublayer plumbing. Weights and state are not
+    # cached on the attention layer, so no tracer outlives a scan or remat.
+    rng = self._attention_rng(kwargs.pop('rng', None))
+    qkv = inputs[:3]
+    passthrough = tuple(inputs[3:])
+    if self.attention.has_backward:
+      out, attention_state = self.attention._do_custom_gradients(  # pylint: disable=protected-access
+          qkv, weights[0], state[0], rng=rng)
+    else:
+      out, attention_state = self.attention.forward_with_state(
+          qkv, weights=weights[0], state=state[0], rng=rng)
+    return (out,) + passthrough, (attention_state,) + tuple(state[1:])
+
   def forward_and_backward(self, inputs, ct, state, new_state, rng=None,
                            **kwargs):
     # Simultaneous forward pass and backprop through the attention mechanism.
@@ -301,14 +1046,18 @@ class ApplyAttentionWrapper(tl.Parallel):
     passthrough = inputs[3:]
     out_ct = ct[0]
     passthrough_ct = ct[1:]
-    if rng is not None:
-      # Adjust RNG to match the forward pass.
-      rng = random.split(rng, self._n_layers)[0]
+    rng = self._attention_rng(rng)
 
     out, qkv_ct = self.attention.forward_and_backward(
         qkv, out_ct, rng=rng, state=state[0], new_state=new_state[0], **kwargs)
     return (out,) + passthrough, qkv_ct + passthrough_ct
 
+  def _attention_rng(self, rng):
+    """Returns the attention's rng, split from rng as tl.Parallel does."""
+    if rng is None:
+      return None
+    return random.split(rng, self._n_layers)[0]
+
 
 class ReversibleAttentionHalfResidual(tl.ReversibleLayer, tl.Serial):
   """Half of a RevNet-style residual that performs attention.
@@ -357,10 +1106,7 @@ class ReversibleAttentionHalfResidual(tl.ReversibleLayer, tl.Serial):
     ]
 
   def reverse(self, output, weights=(), state=(), new_state=(), **kwargs):
-    rng = kwargs.pop('rng', None)
-    rngs = (None,) * self._n_layers
-    if rng is not None:
-      rngs = random.split(rng, self._n_layers)
+    rngs = _pop_rng_and_split(kwargs, self._n_layers)
 
     reconstructed_x = output
     # Note that self.sublayers aligns exactly with self.reverse_layers in
@@ -373,18 +1119,17 @@ class ReversibleAttentionHalfResidual(tl.ReversibleLayer, tl.Serial):
 
   def reverse_and_grad(self, output, ct, weights=(), state=(), new_state=(),
                        **kwargs):
-    rng = kwargs.pop('rng', None)
-    rngs = (None,) * self._n_layers
-    if rng is not None:
-      rngs = random.split(rng, self._n_layers)
+    rngs = _pop_rng_and_split(kwargs, self._n_layers)
 
     # Forward pass through self.pre_attention, while preparing for
-    # later backprop.
+    # later backprop. The function is re-materialized so that its intermediate
+    # activations are not kept alive across the attention computation below;
+    # only its inputs are saved and the rest is recomputed when backpropagating.
     def call_pre_attention(x, weights):
       res = self.pre_attention(x, weights=weights, state=state[0], rng=rngs[0],
                                **kwargs)
       return res
-    stack, pre_attention_vjpfun = jax.vjp(call_pre_attention,
+    stack, pre_attention_vjpfun = jax.vjp(jax.remat(call_pre_attention),
                                           output, weights[0])
 
     # Backprop through adding the residual
@@ -398,6 +1143,8 @@ class ReversibleAttentionHalfResidual(tl.ReversibleLayer, tl.Serial):
       return res
     # Note: these are *not* the actual inputs to self.post_attention.
     # If self.post_attention is not linear, we will get incorrect gradients.
+    # The primal output of this vjp is unused, so under jit it is removed and
+    # only the transposed (input cotangent) computation remains.
     dummy_inputs = (stack[-3], stack[-2], stack[-1])
     _, post_attention_vjpfun = jax.vjp(call_post_attention, dummy_inputs)
     (ct,) = post_attention_vjpfun(ct)
@@ -440,7 +1187,7 @@ class ReversibleAttentionHalfResidual(tl.ReversibleLayer, tl.Serial):
 def DecoderBlock(d_model, d_ff, d_attention_key, d_attention_value,
                  n_heads, n_attention_chunks, attention_type,
                  dropout, share_qk, ff_activation, ff_use_sru, ff_chunk_size,
-                 mode):
+                 mode, ff_n_tiles=1, compute_dtype=None):
   """Reversible transformer decoder layer.
 
   Args:
@@ -457,31 +1204,46 @@ def DecoderBlock(d_model, d_ff, d_attention_key, d_attention_value,
     ff_use_sru: int; if > 0, we use this many SRU layers instead of feed-forward
     ff_chunk_size: int; if > 0, chunk feed-forward into this-sized chunks
     mode: str: 'train' or 'eval'
+    ff_n_tiles: int; with ff_chunk_size > 0, split the hidden layer of each
+      feed-forward chunk into this many tiles along d_ff
+    compute_dtype: if set (e.g. bfloat16), the dtype of the projection and
+      feed-forward matmuls; the reversible carries, layer normalization,
+      attention and weights stay in float32, so reversing the block still
+      reconstructs its inputs
 
   Returns:
     the layer.
   """
+  # Chunking with a single chunk is a no-op, so leave out the reshapes.
+  if n_attention_chunks > 1:
+    layer_norm = ChunkedLayerNorm(n_sections=n_attention_chunks)
+    dropout_layer = UnchunkDropout(
+        n_sections=n_attention_chunks, rate=dropout, mode=mode)
+  else:
+    layer_norm = tl.LayerNorm()
+    dropout_layer = BroadcastedDropout(rate=dropout, mode=mode)  # pylint: disable=no-value-for-parameter
+
+  mixed = _mixed_precision_fn(compute_dtype)
+
   if share_qk:
     pre_attention = [
-        Chunk(n_sections=n_attention_chunks),  # pylint: disable=no-value-for-parameter
-        tl.LayerNorm(),
+        layer_norm,
         tl.Dup(),
-        tl.Parallel(
+        mixed(tl.Parallel(
             tl.ComputeAttentionHeads(n_heads=n_heads, d_head=d_attention_key),
             tl.ComputeAttentionHeads(n_heads=n_heads, d_head=d_attention_value),
-        ),
+        )),
         tl.Dup(),
     ]
   else:
     pre_attention = [
-        Chunk(n_sections=n_attention_chunks),  # pylint: disable=no-value-for-parameter
-        tl.LayerNorm(),
+        layer_norm,
         tl.Dup(), tl.Dup(),
-        tl.Parallel(
+        mixed(tl.Parallel(
             tl.ComputeAttentionHeads(n_heads=n_heads, d_head=d_attention_key),
             tl.ComputeAttentionHeads(n_heads=n_heads, d_head=d_attention_key),
             tl.ComputeAttentionHeads(n_heads=n_heads, d_head=d_attention_value),
-        ),
+        )),
     ]
 
   attention = attention_type(mode=mode)
@@ -489,16 +1251,16 @@ def DecoderBlock(d_model, d_ff, d_attention_key, d_attention_value,
   # ReversibleAttentionHalfResidual requires that post_attention be linear in
   # its input (so the backward pass can be computed without knowing the input)
   post_attention = [
-      tl.ComputeAttentionOutput(n_heads=n_heads, d_model=d_model),
-      Unchunk(n_sections=n_attention_chunks),  # pylint: disable=no-value-for-parameter
-      BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
+      mixed(tl.ComputeAttentionOutput(n_heads=n_heads, d_model=d_model)),
+      dropout_layer,
   ]
 
   if ff_use_sru:
-    feed_forward = [tl.SRU(d_model) for _ in range(ff_use_sru)]
+    feed_forward = [mixed([tl.SRU(d_model) for _ in range(ff_use_sru)])]
   else:
     feed_forward = [ChunkedFeedForward(d_model, d_ff, dropout, ff_activation,
-                                       ff_chunk_size, mode)]
+                                       ff_chunk_size, mode, n_tiles=ff_n_tiles,
+                                       compute_dtype=compute_dtype)]
 
   return [
       ReversibleAttentionHalfResidual(pre_attention, attention, post_attention),
@@ -523,9 +1285,15 @@ def ReformerLM(vocab_size,
                share_qk=False,
                axial_pos_shape=(),
                d_axial_pos_embs=None,
+               fuse_embedding=False,
                ff_activation=tl.FastGelu,
                ff_use_sru=0,
                ff_chunk_size=0,
+               ff_n_tiles=1,
+               checkpoint_policy='reversible',
+               scan_layers=False,
+               n_vocab_tiles=1,
+               compute_dtype=None,
                mode='train'):
   """Reversible transformer language model (only uses a decoder, no encoder).
 
@@ -547,9 +1315,34 @@ def ReformerLM(vocab_size,
       encoding. If unset, axial position encoding is disabled.
     d_axial_pos_embs: tuple of ints: depth of position embedding for each axis.
       Tuple length must match axial_pos_shape, and values must sum to d_model.
+    fuse_embedding: bool: if True (and axial_pos_shape is unset), embed tokens
+      and add the positional encoding in one layer (see FusedEmbedPosDropout).
+      With dropout > 0 this changes the model: dropout is applied once to the
+      sum instead of separately to the embeddings and the position table. Both
+      tables are then held by one layer instead of by separate Embedding and
+      PositionalEncoding layers, so checkpoints are not interchangeable with
+      fuse_embedding=False.
     ff_activation: the non-linearity in feed-forward layer
     ff_use_sru: int; if > 0, we use this many SRU layers instead of feed-forward
     ff_chunk_size: int; if > 0, chunk feed-forward into this-sized chunks
+    ff_n_tiles: int; with ff_chunk_size > 0, split the hidden layer of each
+      feed-forward chunk into this many tiles along d_ff
+    checkpoint_policy: str: how activations of the decoder stack are recovered
+      for the backward pass. 'reversible' reconstructs them by reversing the
+      layers; 'sqrt' instead re-materializes them from O(sqrt(n_layers))
+      checkpoints (requires a single attention_type).
+    scan_layers: bool: with checkpoint_policy='reversible' and a single
+      attention_type (outside of predict mode), compile one decoder block and
+      scan it over the layers. The weights of the decoder stack are then stored
+      stacked along a leading layers axis instead of as one entry per layer, so
+      checkpoints are not interchangeable with scan_layers=False. The 'sqrt'
+      policy always uses the stacked layout.
+    n_vocab_tiles: int; if > 1, compute the output projection and log-softmax
+      of each chunk in this many tiles (see TiledLogSoftmaxDense)
+    compute_dtype: if set (e.g. bfloat16), the dtype of the projection and
+      feed-forward matmuls of the decoder blocks; the reversible carries,
+      layer normalization, attention, weights and the output layer stay in
+      float32
     mode: str: 'train', 'eval', or 'predict'
 
   Returns:
@@ -561,31 +1354,32 @@ def ReformerLM(vocab_size,
   else:
     concatenate_input_chunks = tl.Concatenate(n_items=n_chunks)
 
-  if not axial_pos_shape:
-    positional_encoding = tl.PositionalEncoding(
-        max_len=max_len, dropout=dropout, mode=mode)
+  if fuse_embedding and not axial_pos_shape:
+    positional_embedder = FusedEmbedPosDropout(
+        vocab_size, d_model, max_len=max_len, dropout=dropout, mode=mode)
   else:
-    assert d_axial_pos_embs is not None
-    positional_encoding = tl.AxialPositionalEncoding(
-        shape=axial_pos_shape, d_embs=d_axial_pos_embs,
-        dropout_broadcast_dims=tuple(range(1, len(axial_pos_shape) + 1)),
-        dropout=dropout, mode=mode)
-
-  positional_embedder = [
-      tl.Embedding(d_model, vocab_size),
-      BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
-      positional_encoding,
-  ]
-
-  decoder_blocks = []
+    if not axial_pos_shape:
+      positional_encoding = tl.PositionalEncoding(
+          max_len=max_len, dropout=dropout, mode=mode)
+    else:
+      assert d_axial_pos_embs is not None
+      positional_encoding = tl.AxialPositionalEncoding(
+          shape=axial_pos_shape, d_embs=d_axial_pos_embs,
+          dropout_broadcast_dims=tuple(range(1, len(axial_pos_shape) + 1)),
+          dropout=dropout, mode=mode)
+    positional_embedder = [
+        tl.Embedding(d_model, vocab_size),
+        BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
+        positional_encoding,
+    ]
 
   if isinstance(attention_type, (tuple, list)):
     assert n_layers % len(attention_type) == 0
   else:
     attention_type = [attention_type]
-  for layer_idx in range(n_layers):
-    layer_attention_type = attention_type[layer_idx % len(attention_type)]
-    decoder_block = DecoderBlock(
+
+  def decoder_block(layer_attention_type):
+    return DecoderBlock(
         d_model, d_ff, d_attention_key, d_attention_value, n_heads,
         n_attention_chunks,
         attention_type=layer_attention_type,
@@ -595,24 +1389,52 @@ def ReformerLM(vocab_size,
         ff_activation=ff_activation,
         ff_use_sru=ff_use_sru,
         ff_chunk_size=ff_chunk_size,
-        mode=mode)
-    decoder_blocks.append(decoder_block)
+        ff_n_tiles=ff_n_tiles,
+        mode=mode,
+        compute_dtype=compute_dtype)
+
+  if checkpoint_policy == 'sqrt':
+    if len(attention_type) != 1:
+      raise ValueError(
+          "checkpoint_policy='sqrt' requires a single attention_type.")
+    decoder_stack = tl.Serial(
+        tl.CheckpointedScannedSerial(
+            functools.partial(decoder_block, attention_type[0]), n_layers),
+        SplitForOutput(n_sections=n_chunks, axis=-2),  # pylint: disable=no-value-for-parameter
+    )
+  elif checkpoint_policy == 'reversible':
+    if scan_layers and len(attention_type) == 1 and mode != 'predict':
+      # All layers are identical, so compile a single block and scan it over
+      # the stacked per-layer weights.
+      decoder_blocks = [tl.ScannedReversibleSerial(
+          functools.partial(decoder_block, attention_type[0]), n_layers)]
+    else:
+      decoder_blocks = [
+          decoder_block(attention_type[layer_idx % len(attention_type)])
+          for layer_idx in range(n_layers)]
+    decoder_stack = tl.ReversibleSerial(decoder_blocks + [
+        SplitForOutput(n_sections=n_chunks, axis=-2),  # pylint: disable=no-value-for-parameter
+    ])
+  else:
+    raise ValueError('Unknown checkpoint_policy: %s' % checkpoint_policy)
+
+  if n_vocab_tiles > 1:
+    output_layer = TiledLogSoftmaxDense(vocab_size, n_tiles=n_vocab_tiles)
+  else:
+    output_layer = [tl.Dense(vocab_size), tl.LogSoftmax()]
 
   return tl.Serial(
       concatenate_input_chunks,
       tl.ShiftRight(mode=mode),
       positional_embedder,
       tl.Dup(),
-      tl.ReversibleSerial(decoder_blocks + [
-          SplitForOutput(n_sections=n_chunks, axis=-2),  # pylint: disable=no-value-for-parameter
-      ]),
+      decoder_stack,
       Map([
           # TODO(kitaev): Test whether dropout should go before or after the
           # LayerNorm, and whether dropout broadcasting is needed here.
           tl.LayerNorm(),
           BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
-          tl.Dense(vocab_size),
-          tl.LogSoftmax(),
+          output_layer,
       ], n_sections=n_chunks),
   )
 
@@ -636,6 +1458,8 @@ def ReformerShortenLM(vocab_size,
                       ff_activation=tl.FastGelu,
                       ff_use_sru=0,
                       ff_chunk_size=0,
+                      ff_n_tiles=1,
+                      scan_layers=False,
                       mode='train'):
   """Reversible transformer language model with shortening.
 
@@ -669,6 +1493,12 @@ def ReformerShortenLM(vocab_size,
     ff_activation: the non-linearity in feed-forward layer
     ff_use_sru: int; if > 0, we use this many SRU layers instead of feed-forward
     ff_chunk_size: int; if > 0, chunk feed-forward into this-sized chunks
+    ff_n_tiles: int; with ff_chunk_size > 0, split the hidden layer of each
+      feed-forward chunk into this many tiles along d_ff
+    scan_layers: bool: with a single attention_type, compile one decoder block
+      and scan it over the layers. The weights of the decoder stack are then
+      stored stacked along a leading layers axis instead of as one entry per
+      layer, so checkpoints are not interchangeable with scan_layers=False.
     mode: str: 'train' or 'eval'
 
   Returns:
@@ -692,15 +1522,13 @@ def ReformerShortenLM(vocab_size,
       positional_encoding,
   ]
 
-  decoder_blocks = []
-
   if isinstance(attention_type, (tuple, list)):
     assert n_layers % len(attention_type) == 0
   else:
     attention_type = [attention_type]
-  for layer_idx in range(n_layers):
-    layer_attention_type = attention_type[layer_idx % len(attention_type)]
-    decoder_block = DecoderBlock(
+
+  def decoder_block(layer_attention_type):
+    return DecoderBlock(
         d_model, d_ff, d_attention_key, d_attention_value, n_heads,
         n_attention_chunks,
         attention_type=layer_attention_type,
@@ -710,8 +1538,18 @@ def ReformerShortenLM(vocab_size,
         ff_activation=ff_activation,
         ff_use_sru=ff_use_sru,
         ff_chunk_size=ff_chunk_size,
+        ff_n_tiles=ff_n_tiles,
         mode=mode)
-    decoder_blocks.append(decoder_block)
+
+  if scan_layers and len(attention_type) == 1:
+    # All layers are identical, so compile a single block and scan it over
+    # the stacked per-layer weights.
+    decoder_blocks = [tl.ScannedReversibleSerial(
+        functools.partial(decoder_block, attention_type[0]), n_layers)]
+  else:
+    decoder_blocks = [
+        decoder_block(attention_type[layer_idx % len(attention_type)])
+        for layer_idx in range(n_layers)]
 
   # pylint: disable=g-long-lambda
   return tl.Serial(
@@ -748,7 +1586,30 @@ def ReformerShortenLM(vocab_size,
   # pylint: enable=g-long-lambda
 
 
-def EncoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode):
+class AverageAndLayerNorm(tl.Layer):
+  """Averages two inputs and applies LayerNorm to the result, as one layer."""
+
+  def __init__(self):
+    super(AverageAndLayerNorm, self).__init__(n_in=2)
+    self._layer_norm = tl.LayerNorm()
+
+  def forward(self, inputs, weights):
+    x, y = inputs
+    return self._layer_norm.forward((x + y) * 0.5, weights)
+
+  def new_weights(self, input_signature):
+    return self._layer_norm.new_weights(input_signature[0])
+
+
+def _mixed_precision_fn(compute_dtype):
+  """Returns a function wrapping layers in MixedPrecision(compute_dtype)."""
+  if compute_dtype is None:
+    return lambda layer: layer
+  return lambda layer: MixedPrecision(layer, compute_dtype)
+
+
+def EncoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode,
+                 compute_dtype=None, ff_gated=False):
   """Returns a list of layers that implements a Reformer encoder block.
 
   The input to the layer is a pair, (activations, mask), where the mask was
@@ -762,23 +1623,37 @@ def EncoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode):
     dropout: float: dropout rate (how much to drop out)
     ff_activation: the non-linearity in feed-forward layer
     mode: str: 'train' or 'eval'
+    compute_dtype: if set (e.g. bfloat16), the dtype of the projection and
+      feed-forward matmuls; layer normalization, attention softmax and weights
+      stay in float32
+    ff_gated: bool: if True, use GatedFeedForward instead of a plain
+      feed-forward layer
 
   Returns:
     A list of layers that maps (activations, mask) to (activations, mask).
   """
-  pre_attention = tl.LayerNorm()
-  attention = tl.Attention(
-      d_model, n_heads=n_heads, dropout=dropout, mode=mode)
-  post_attention = tl.Dropout(
-      rate=dropout, name='dropout_enc_attn', mode=mode)
+  mixed = _mixed_precision_fn(compute_dtype)
+
+  # LayerNorm and the q, k, v projections of tl.Attention, as a single layer.
+  pre_attention = LayerNormQKV(d_model, compute_dtype=compute_dtype)
+  attention = [
+      tl.PureAttention(n_heads=n_heads, dropout=dropout, mode=mode),
+      mixed(tl.Dense(d_model)),
+  ]
+  post_attention = BroadcastedDropout(rate=dropout, mode=mode)  # pylint: disable=no-value-for-parameter
 
-  # TODO(kitaev): Switch to FeedForward with BroadcastedDropout?
-  feed_forward = transformer._FeedForwardBlock(  # pylint: disable=protected-access
-      d_model, d_ff, dropout, -1, mode, ff_activation)
-  # feed_forward = FeedForward(d_model, d_ff, dropout, ff_activation, mode)
+  if ff_gated:
+    feed_forward = GatedFeedForward(d_model, d_ff, dropout, ff_activation, mode)
+  else:
+    # TODO(kitaev): Switch to FeedForward with BroadcastedDropout?
+    feed_forward = transformer._FeedForwardBlock(  # pylint: disable=protected-access
+        d_model, d_ff, dropout, -1, mode, ff_activation)
+    # feed_forward = FeedForward(d_model, d_ff, dropout, ff_activation, mode)
+  feed_forward = [feed_forward[0], mixed(feed_forward[1:])]  # Keep LayerNorm.
 
   return [
       # TODO(kitaev): consider ReversibleAttentionHalfResidual for efficiency
+      # (requires an attention with forward_and_backward that takes a mask).
       ReversibleHalfResidual([pre_attention, attention, post_attention]),
       tl.ReversibleSwap(),
       ReversibleHalfResidual(feed_forward),
@@ -786,7 +1661,8 @@ def EncoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode):
   ]
 
 
-def EncoderDecoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode):
+def EncoderDecoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode,
+                        compute_dtype=None, ff_gated=False):
   """Reversible transformer decoder layer.
 
   Args:
@@ -796,32 +1672,52 @@ def EncoderDecoderBlock(d_model, d_ff, n_heads, dropout, ff_activation, mode):
     dropout: float: dropout rate (how much to drop out)
     ff_activation: the non-linearity in feed-forward layer
     mode: str: 'train' or 'eval'
+    compute_dtype: if set (e.g. bfloat16), the dtype of the projection and
+      feed-forward matmuls; layer normalization, attention softmax and weights
+      stay in float32
+    ff_gated: bool: if True, use GatedFeedForward instead of a plain
+      feed-forward layer
 
   Returns:
     the layer.
   """
+  mixed = _mixed_precision_fn(compute_dtype)
+
   pre_attention_qkv = [
       tl.LayerNorm(),
-      tl.Select([0, 2, 2, 1, 2]),  # vec_d vec_e vec_e masks vec_e
+      tl.Select([0, 2, 1, 2]),  # vec_d vec_e masks vec_e
+  ]
+  # Like tl.AttentionQKV, but keys and values (which are both projected from
+  # vec_e) come from a single matmul.
+  attention_qkv = [
+      # q k v masks vec_e
+      mixed(tl.Parallel(tl.Dense(d_model), ProjectKV(d_model))),
+      tl.PureAttention(n_heads=n_heads, dropout=dropout, mode=mode),
+      mixed(tl.Dense(d_model)),
   ]
-  attention_qkv = tl.AttentionQKV(
-      d_model, n_heads=n_heads, dropout=dropout, mode=mode)
-  # TODO(kitaev): BroadcastedDropout?
-  post_attention_qkv = tl.Dropout(rate=dropout, mode=mode)
+  post_attention_qkv = BroadcastedDropout(rate=dropout, mode=mode)  # pylint: disable=no-value-for-parameter
 
-  pre_causal_attention = tl.LayerNorm()
-  causal_attention = tl.CausalAttention(
-      d_model, n_heads=n_heads, mode=mode)
-  # TODO(kitaev): BroadcastedDropout?
-  post_causal_attention = tl.Dropout(rate=dropout, mode=mode)
+  # LayerNorm and the q, k, v heads of tl.CausalAttention, as a single layer.
+  pre_causal_attention = LayerNormQKV(
+      d_model, n_heads=n_heads, use_bias=False, compute_dtype=compute_dtype)
+  causal_attention = tl.DotProductCausalAttention(mode=mode)
+  # ReversibleAttentionHalfResidual requires that post_attention be linear in
+  # its input (so the backward pass can be computed without knowing the input)
+  post_causal_attention = [
+      mixed(tl.ComputeAttentionOutput(n_heads=n_heads, d_model=d_model)),
+      BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
+  ]
 
-  feed_forward = FeedForward(d_model, d_ff, dropout, ff_activation, mode)
+  feed_forward_fn = GatedFeedForward if ff_gated else FeedForward
+  feed_forward = feed_forward_fn(d_model, d_ff, dropout, ff_activation, mode)
+  feed_forward = [feed_forward[0], mixed(feed_forward[1:])]  # Keep LayerNorm.
 
   return [                             # vec_d1 vec_d2 masks vec_e
-      # TODO(kitaev): consider ReversibleAttentionHalfResidual for efficiency
-      ReversibleHalfResidual(
-          [pre_causal_attention, causal_attention, post_causal_attention]),
+      ReversibleAttentionHalfResidual(
+          pre_causal_attention, causal_attention, post_causal_attention),
       tl.ReversibleSwap(),
+      # TODO(kitaev): consider ReversibleAttentionHalfResidual for efficiency
+      # (requires an attention with forward_and_backward that takes a mask).
       ReversibleHalfResidual(
           [pre_attention_qkv, attention_qkv, post_attention_qkv]),
       tl.ReversibleSwap(),
@@ -839,7 +1735,17 @@ def Reformer(input_vocab_size,
              n_heads=8,
              dropout=0.1,
              max_len=2048,
+             axial_pos_shape=(),
+             d_axial_pos_embs=None,
              ff_activation=tl.Relu,
+             ff_gated=False,
+             compute_dtype=None,
+             quantize_embeddings=False,
+             pos_encoding_dtype=None,
+             remat_bookends=False,
+             scan_layers=False,
+             fused_loss=False,
+             n_vocab_tiles=1,
              mode='train'):
   """Reversible transformer encoder-decoder model.
 
@@ -859,48 +1765,131 @@ def Reformer(input_vocab_size,
     n_heads: int: number of attention heads
     dropout: float: dropout rate (how much to drop out)
     max_len: int: maximum symbol length for positional encoding
+    axial_pos_shape: tuple of ints: input shape to use for the axial position
+      encoding (its product bounds the sequence length instead of max_len). If
+      unset, axial position encoding is disabled.
+    d_axial_pos_embs: tuple of ints: depth of position embedding for each axis.
+      Tuple length must match axial_pos_shape, and values must sum to d_model.
     ff_activation: the non-linearity in feed-forward layer
+    ff_gated: bool: if True, use GatedFeedForward instead of a plain
+      feed-forward layer
+    compute_dtype: if set (e.g. bfloat16), the dtype of the projection and
+      feed-forward matmuls; layer normalization, attention softmax and weights
+      stay in float32
+    quantize_embeddings: bool: if True, store the token embeddings as int8
+      tables (see Int8Embedding); only supported outside of training
+    pos_encoding_dtype: if set (e.g. bfloat16), the dtype in which the
+      positional encoding table is stored (see LowPrecisionPositionalEncoding);
+      ignored for axial position encoding
+    remat_bookends: bool: if True, the non-reversible layers after each
+      reversible stack (normalization and the output projection) recompute
+      their activations on the backward pass instead of storing them
+    scan_layers: bool: if True, compile one encoder and one decoder block and
+      scan each over its layers. The weights of each stack are then stored
+      stacked along a leading layers axis instead of as one entry per layer,
+      so checkpoints are not interchangeable with scan_layers=False.
+    fused_loss: bool: if True, in 'train' mode the output projection is fused
+      with the cross-entropy (see TiledLogSoftmaxCrossEntropy), and the model
+      outputs the negative log-probability of each target instead of
+      log-probabilities; train it with loss_fn=tl.NegLogProbLoss. In 'eval'
+      mode the model still outputs log-probabilities, computed by
+      TiledLogSoftmaxDense, which has the same weights. The output head then
+      stores (w, b) rather than the ((w, b), ()) of Dense and LogSoftmax.
+    n_vocab_tiles: int: number of vocab tiles for the fused cross-entropy;
+      only used (and only allowed above 1) with fused_loss
     mode: str: 'train' or 'eval'
 
   Returns:
     A Reformer model as a layer that maps from a target, source pair to
-    activations over a vocab set.
+    activations over a vocab set. Every call builds a new model: layers cache
+    their own weights and state, so models are not memoized across calls.
   """
-  # The current API for custom gradients assumes that a layer must be
-  # differentiable wrt all of its inputs, but the Transformer puts bool-dtype
-  # masks on the stack. This causes jax to error, even though the so-called
-  # "gradient" wrt the masks is never actually computed.
-  # TODO(kitaev): remove this hack.
-  jax.api._check_inexact_input_vjp = lambda x: None  # pylint: disable=protected-access
-
-  def PositionalEncoder(vocab_size):  # tokens --> vectors
-    # TODO(kitaev): axial positional encoding is better for very long sequences.
-    # TODO(kitaev): dropout=0.0 for tl.PositionalEncoding matches trax
-    # Transformer, but may not be the right option in general.
-    positional_encoding = tl.PositionalEncoding(
-        max_len=max_len, dropout=0.0, mode=mode)
+  # TODO(kitaev): dropout=0.0 for tl.PositionalEncoding matches trax
+  # Transformer, but may not be the right option in general.
+  if not axial_pos_shape:
+    if pos_encoding_dtype is None:
+      positional_encoding = tl.PositionalEncoding(
+          max_len=max_len, dropout=0.0, mode=mode)
+    else:
+      positional_encoding = LowPrecisionPositionalEncoding(
+          max_len=max_len, dropout=0.0, mode=mode, dtype=pos_encoding_dtype)
+  else:
+    # Axial encodings take O(sum(axial_pos_shape)) rather than O(max_len)
+    # parameters, which matters for very long sequences.
+    assert d_axial_pos_embs is not None
+    positional_encoding = tl.AxialPositionalEncoding(
+        shape=axial_pos_shape, d_embs=d_axial_pos_embs, dropout=0.0, mode=mode)
+
+  def PositionalEncoder(embedding):  # tokens --> vectors
+    # The positional_encoding layer is shared by the source and target sides:
+    # a layer that is used twice only holds (and is initialized with) a
+    # single copy of its weights.
     return [
-        tl.Embedding(d_model, vocab_size),
-        # TODO(kitaev): BroadcastedDropout?
-        tl.Dropout(rate=dropout, mode=mode),
+        embedding,
+        BroadcastedDropout(rate=dropout, mode=mode),  # pylint: disable=no-value-for-parameter
         positional_encoding,
     ]
 
-  in_encoder = PositionalEncoder(input_vocab_size)
-  out_encoder = (in_encoder if output_vocab_size is None
-                 else PositionalEncoder(output_vocab_size))
+  if quantize_embeddings and mode == 'train':
+    raise ValueError('Quantized embeddings are not trainable.')
+  embedding_layer = Int8Embedding if quantize_embeddings else tl.Embedding
+  in_embedding = embedding_layer(d_model, input_vocab_size)
   if output_vocab_size is None:
+    # A shared vocab also shares the embedding table.
     output_vocab_size = input_vocab_size
+    out_embedding = in_embedding
+  else:
+    out_embedding = embedding_layer(d_model, output_vocab_size)
+  in_encoder = PositionalEncoder(in_embedding)
+  # Decoder tokens are shifted right as part of the embedding lookup.
+  out_encoder = PositionalEncoder(ShiftedEmbedding(out_embedding))
+
+  def blocks(block_fn, n_layers):
+    if n_layers < 1:
+      return []
+    if scan_layers:
+      # All blocks are identical, so compile a single block and scan it over
+      # the stacked per-layer weights.
+      return [tl.ScannedReversibleSerial(block_fn, n_layers)]
+    return [block_fn() for _ in range(n_layers)]
+
+  encoder_blocks = blocks(
+      functools.partial(EncoderBlock, d_model, d_ff, n_heads, dropout,
+                        ff_activation, mode, compute_dtype=compute_dtype,
+                        ff_gated=ff_gated),
+      n_encoder_layers)
+
+  encoder_decoder_blocks = blocks(
+      functools.partial(EncoderDecoderBlock, d_model, d_ff, n_heads, dropout,
+                        ff_activation, mode, compute_dtype=compute_dtype,
+                        ff_gated=ff_gated),
+      n_decoder_layers)
+
+  if n_vocab_tiles > 1 and not fused_loss:
+    raise ValueError('n_vocab_tiles is only supported with fused_loss.')
+  if not fused_loss:
+    output_layers = [
+        tl.Select([0], n_in=3),               # vec_d tok_d
+        tl.Dense(output_vocab_size),
+        tl.LogSoftmax(),
+    ]
+  elif mode == 'train':
+    output_layers = [
+        tl.Select([0, 3, 3], n_in=4),         # vec_d tok_d tok_d
+        TiledLogSoftmaxCrossEntropy(output_vocab_size, n_tiles=n_vocab_tiles),
+    ]
+  else:
+    # Same weights as the fused training head, but full log-probabilities.
+    output_layers = [
+        tl.Select([0], n_in=3),               # vec_d tok_d
+        TiledLogSoftmaxDense(output_vocab_size),
+    ]
 
-  encoder_blocks = [
-      EncoderBlock(
-          d_model, d_ff, n_heads, dropout, ff_activation, mode)
-      for _ in range(n_encoder_layers)]
-
-  encoder_decoder_blocks = [
-      EncoderDecoderBlock(
-          d_model, d_ff, n_heads, dropout, ff_activation, mode)
-      for _ in range(n_decoder_layers)]
+  encoder_output_layers = AverageAndLayerNorm()
+  decoder_output_layers = [AverageAndLayerNorm()] + output_layers
+  if remat_bookends:
+    encoder_output_layers = Remat(encoder_output_layers)
+    decoder_output_layers = Remat(decoder_output_layers)
 
   # Assemble and return the model.
   return tl.Serial(
@@ -909,8 +1898,7 @@ def Reformer(input_vocab_size,
       tl.Select([0, 1, 1]),               # tok_e tok_d tok_d
 
       # Encode.
-      tl.Branch(
-          in_encoder, tl.PaddingMask()),    # vec_e  masks  tok_d .....
+      EmbedAndMask(in_encoder),             # vec_e  masks  tok_d .....
       tl.Dup(),                             # vec_e1 vec_e2 masks tok_d .....
       tl.ReversibleSerial(encoder_blocks),  # vec_e1 vec_e2 masks tok_d .....
       # The two sets of activations need to be reduced to one, in this case by
@@ -918,23 +1906,15 @@ def Reformer(input_vocab_size,
       # options (concat, average, add, keep only one, etc.) seem to perform
       # similarly. We don't concatenate here because we want exact parameter
       # parity with the standard Transformer.
-      tl.Fn(lambda x, y: (x+y)/2.0),        # vec_e  masks tok_d .....
-      tl.LayerNorm(),                       # vec_e  masks tok_d .....
+      encoder_output_layers,                # vec_e  masks tok_d .....
 
       # Decode.
       tl.Select([2, 1, 0]),                 # tok_d masks vec_e .....
-      tl.ShiftRight(),                      # tok_d masks vec_e .....
       out_encoder,                          # vec_d masks vec_e .....
-      tl.Branch(
-          [], tl.EncoderDecoderMask()),     # vec_d masks vec_e .....
-      tl.Dup(),                             # vec_d1 vec_d2 masks vec_e .....
+      MaskAndDup(),                         # vec_d1 vec_d2 masks vec_e .....
       tl.ReversibleSerial(encoder_decoder_blocks),
-      tl.Fn(lambda x, y: (x+y)/2.0),        # vec_d masks vec_e .....
-      tl.LayerNorm(),                       # vec_d masks vec_e .....
 
-      # Map to output vocab.
-      tl.Select([0], n_in=3),               # vec_d .....
-      tl.Dense(output_vocab_size),          # vec_d .....
-      tl.LogSoftmax(),                      # vec_d .....
+      # Average, normalize and map to output vocab.
+      decoder_output_layers,                # vec_d .....
   )
 
@@ -76,6 +76,687 @@ class ReformerTest(parameterized.TestCase):
         model, input_signature)
     self.assertEqual(((1, 8, 16), (1, 8, 16)), final_shape)
 
+  def test_reformer_lm_sqrt_checkpointing_forward_shape(self):
+    vocab_size = 16
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.ReformerLM(
+        vocab_size, d_model=32, d_ff=64,
+        d_attention_key=16, d_attention_value=16, n_layers=4, n_heads=2,
+        max_len=16, n_chunks=2, n_attention_chunks=1,
+        checkpoint_policy='sqrt')
+    final_shape = tl.check_shape_agreement(
+        model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8, 16)), final_shape)
+
+  def test_reformer_lm_sqrt_checkpointing_matches_reversible(self):
+    with math.use_backend('jax'):
+      input_sd = ShapeDtype((1, 8), np.int32)
+      input_signature = (input_sd, input_sd)
+      def build(checkpoint_policy):
+        # With scan_layers, both policies store the same stacked weights.
+        return reformer.ReformerLM(
+            16, d_model=32, d_ff=64, d_attention_key=16, d_attention_value=16,
+            n_layers=4, n_heads=2, dropout=0.0, max_len=16, n_chunks=2,
+            n_attention_chunks=1, checkpoint_policy=checkpoint_policy,
+            scan_layers=True)
+      reversible_model = build('reversible')
+      sqrt_model = build('sqrt')
+      weights, state = reversible_model.init(input_signature)
+      sqrt_model.init(input_signature)
+
+      inputs = tuple(onp.random.randint(16, size=(1, 8)).astype(onp.int32)
+                     for _ in range(2))
+      rng = math.random.get_prng(0)
+      def loss_and_grads(model):
+        def loss(weights):
+          output = model(inputs, weights=weights, state=state, rng=rng)
+          return np.sum(output[0] * output[0])
+        return loss(weights), math.grad(loss)(weights)
+
+      expected_loss, expected_grads = loss_and_grads(reversible_model)
+      sqrt_loss, sqrt_grads = loss_and_grads(sqrt_model)
+      onp.testing.assert_allclose(sqrt_loss, expected_loss, rtol=1e-5)
+      for expected, grad in zip(jax.tree_util.tree_leaves(expected_grads),
+                                jax.tree_util.tree_leaves(sqrt_grads)):
+        onp.testing.assert_allclose(grad, expected, rtol=1e-4, atol=1e-5)
+
+  def test_reformer_lm_scan_layers_forward_shape(self):
+    vocab_size = 16
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.ReformerLM(
+        vocab_size, d_model=32, d_ff=64,
+        d_attention_key=16, d_attention_value=16, n_layers=2, n_heads=2,
+        max_len=16, n_chunks=2, n_attention_chunks=1, scan_layers=True)
+    final_shape = tl.check_shape_agreement(
+        model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8, 16)), final_shape)
+
+  def test_scanned_reversible_serial_matches_unrolled(self):
+    with math.use_backend('jax'):
+      def block_fn():
+        return [
+            reformer.ReversibleHalfResidual([tl.LayerNorm(), tl.Dense(8)]),
+            tl.ReversibleSwap(),
+            reformer.ReversibleHalfResidual([tl.Dense(8), tl.Relu()]),
+            tl.ReversibleSwap(),
+        ]
+      n_layers = 3
+      scanned = tl.ScannedReversibleSerial(block_fn, n_layers)
+      unrolled = tl.ReversibleSerial([block_fn() for _ in range(n_layers)])
+      input_signature = (ShapeDtype((2, 4, 8)), ShapeDtype((2, 4, 8)))
+      weights, state = scanned.init(input_signature)
+      unrolled.init(input_signature)
+
+      def unstack(tree):
+        return [leaf for i in range(n_layers)
+                for leaf in jax.tree_util.tree_map(lambda x: x[i], tree)]  # pylint: disable=cell-var-from-loop
+      layer_weights, layer_state = unstack(weights), unstack(state)
+
+      x = tuple(onp.random.uniform(size=(2, 4, 8)).astype(onp.float32)
+                for _ in range(2))
+      ct = tuple(onp.random.uniform(size=(2, 4, 8)).astype(onp.float32)
+                 for _ in range(2))
+      rng = math.random.get_prng(0)
+      y = scanned(x, weights=weights, state=state, rng=rng)
+      expected_y = unrolled(x, weights=layer_weights, state=layer_state,
+                            rng=rng)
+      for actual, expected in zip(y, expected_y):
+        onp.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+      reversed_x = scanned.reverse(y, weights, state, state)
+      expected_x = unrolled.reverse(y, layer_weights, layer_state, layer_state)
+      for actual, expected in zip(reversed_x, expected_x):
+        onp.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+      reversed_x, (x_ct, weights_ct) = scanned.reverse_and_grad(
+          y, ct, weights, state, state)
+      expected_x, (expected_x_ct, expected_weights_ct) = (
+          unrolled.reverse_and_grad(
+              y, ct, layer_weights, layer_state, layer_state))
+      for actual, expected in zip(
+          jax.tree_util.tree_leaves((reversed_x, x_ct, unstack(weights_ct))),
+          jax.tree_util.tree_leaves(
+              (expected_x, expected_x_ct, expected_weights_ct))):
+        onp.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+  def test_reversible_half_residual_grad_with_bool_passthrough(self):
+    with math.use_backend('jax'):
+      layer = reformer.ReversibleHalfResidual([tl.LayerNorm(), tl.Dense(8)])
+      input_signature = (ShapeDtype((2, 4, 8)), ShapeDtype((2, 4, 8)),
+                         ShapeDtype((2, 4), onp.bool_))
+      weights, state = layer.init(input_signature)
+      x1, x2 = (onp.random.uniform(size=(2, 4, 8)).astype(onp.float32)
+                for _ in range(2))
+      mask = onp.random.uniform(size=(2, 4)) > 0.5
+      y = layer((x1, x2, mask), weights=weights, state=state)
+      ct = tuple(onp.random.uniform(size=(2, 4, 8)).astype(onp.float32)
+                 for _ in range(2)) + (onp.zeros((2, 4), onp.bool_),)
+
+      reversed_x, (x_ct, _) = layer.reverse_and_grad(
+          y, ct, weights, state, state)
+      for actual, expected in zip(reversed_x, (x1, x2, mask)):
+        onp.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+      # The mask's cotangent is passed through as given.
+      self.assertIs(ct[2], x_ct[2])
+
+      def forward(x1, x2):
+        return layer((x1, x2, mask), weights=weights, state=state)[:2]
+      _, vjpfun = jax.vjp(forward, x1, x2)
+      for actual, expected in zip(x_ct[:2], vjpfun(ct[:2])):
+        onp.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+  def test_reformer_lm_bfloat16_matmuls_forward_shape(self):
+    vocab_size = 16
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.ReformerLM(
+        vocab_size, d_model=32, d_ff=64,
+        d_attention_key=16, d_attention_value=16, n_layers=2, n_heads=2,
+        max_len=16, n_chunks=2, n_attention_chunks=1,
+        compute_dtype=jax.numpy.bfloat16)
+    final_shape = tl.check_shape_agreement(
+        model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8, 16)), final_shape)
+
+  def test_decoder_block_bfloat16_matmuls_reverse(self):
+    with math.use_backend('jax'):
+      # Positional arguments as in DecoderBlock's original signature.
+      layer = tl.ReversibleSerial(reformer.DecoderBlock(
+          32, 64, 16, 16, 2, 1, tl.DotProductCausalAttention, 0.0, False,
+          tl.Relu, 0, 0, 'train', compute_dtype=jax.numpy.bfloat16))
+      input_signature = (ShapeDtype((2, 8, 32)), ShapeDtype((2, 8, 32)))
+      weights, state = layer.init(input_signature)
+      x = tuple(onp.random.uniform(size=(2, 8, 32)).astype(onp.float32)
+                for _ in range(2))
+      rng = math.random.get_prng(0)
+      y = layer(x, weights=weights, state=state, rng=rng)
+      for output in y:
+        self.assertEqual(np.float32, output.dtype)
+
+      # The carries stay in float32, so reversing the block reconstructs its
+      # inputs to float32 precision despite the bfloat16 matmuls.
+      reversed_x = layer.reverse(y, weights, state, state, rng=rng)
+      for actual, expected in zip(reversed_x, x):
+        onp.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+  def test_reformer_forward_shape(self):
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.Reformer(
+        16, d_model=32, d_ff=64, n_encoder_layers=1, n_decoder_layers=1,
+        n_heads=2, max_len=16)
+    final_shape = tl.check_shape_agreement(model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8)), final_shape)
+    # The output head keeps separate Dense and LogSoftmax layers.
+    (w, b), log_softmax_weights = model.weights[-2:]
+    self.assertEqual((32, 16), w.shape)
+    self.assertEqual((16,), b.shape)
+    self.assertEqual((), log_softmax_weights)
+
+  def test_reformer_axial_pos_forward_shape(self):
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.Reformer(
+        16, d_model=32, d_ff=64, n_encoder_layers=1, n_decoder_layers=1,
+        n_heads=2, axial_pos_shape=(4, 4), d_axial_pos_embs=(16, 16))
+    final_shape = tl.check_shape_agreement(model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8)), final_shape)
+
+  def test_broadcasted_dropout_bfloat16(self):
+    with math.use_backend('jax'):
+      layer = reformer.BroadcastedDropout(rate=0.1, mode='train')  # pylint: disable=no-value-for-parameter
+      input_signature = ShapeDtype((4, 1, 4096), jax.numpy.bfloat16)
+      layer.init(input_signature)
+      x = onp.ones((4, 1, 4096), dtype=jax.numpy.bfloat16)
+      y = layer(x, rng=math.random.get_prng(0))
+      self.assertEqual(jax.numpy.bfloat16, y.dtype)
+      y = onp.asarray(y, dtype=onp.float32)
+      # The noise is drawn in float32, so the keep rate is not snapped to the
+      # bfloat16 grid and stays consistent with the 1 / keep_prob rescale.
+      self.assertAlmostEqual(0.9, onp.mean(y != 0), delta=0.01)
+      scale = onp.float32(onp.asarray(1.0 / 0.9, dtype=jax.numpy.bfloat16))
+      onp.testing.assert_array_equal(scale, y[y != 0])
+
+  @parameterized.named_parameters(('reformer_lm', True), ('reformer', False))
+  def test_bfloat16_matmuls_with_dropout_train(self, lm):
+    with math.use_backend('jax'):
+      input_sd = ShapeDtype((2, 8), np.int32)
+      if lm:
+        # Chunks of the tiled feed-forward run their dropout in bfloat16.
+        model = reformer.ReformerLM(
+            16, d_model=32, d_ff=64, d_attention_key=16, d_attention_value=16,
+            n_layers=2, n_heads=2, dropout=0.1, max_len=16, ff_chunk_size=4,
+            ff_n_tiles=2, compute_dtype=jax.numpy.bfloat16, mode='train')
+      else:
+        model = reformer.Reformer(
+            16, d_model=32, d_ff=64, n_encoder_layers=2, n_decoder_layers=2,
+            n_heads=2, dropout=0.1, max_len=16,
+            compute_dtype=jax.numpy.bfloat16, mode='train')
+      weights, state = model.init((input_sd, input_sd))
+      tokens = onp.random.randint(1, 16, size=(2, 8)).astype(onp.int32)
+      log_probs = model((tokens, tokens), weights=weights, state=state,
+                        rng=math.random.get_prng(0))[0]
+      self.assertEqual(np.float32, log_probs.dtype)
+      self.assertTrue(onp.all(onp.isfinite(log_probs)))
+
+  def test_reformer_bfloat16_matmuls_forward_shape(self):
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.Reformer(
+        16, d_model=32, d_ff=64, n_encoder_layers=1, n_decoder_layers=1,
+        n_heads=2, max_len=16, compute_dtype=jax.numpy.bfloat16)
+    final_shape = tl.check_shape_agreement(model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8)), final_shape)
+
+  def test_reformer_remat_bookends_forward_shape(self):
+    input_sd = ShapeDtype((1, 8), np.int32)
+    input_signature = (input_sd, input_sd)
+    model = reformer.Reformer(
+        16, d_model=32, d_ff=64, n_encoder_layers=1, n_decoder_layers=1,
+        n_heads=2, max_len=16, remat_bookends=True)
+    final_shape = tl.check_shape_agreement(model, input_signature)
+    self.assertEqual(((1, 8, 16), (1, 8)), final_shape)
+
+  def test_reformer_scan_layers_matches_unrolled(self):
+    with math.use_backend('jax'):
+      input_sd = ShapeDtype((1, 8), np.int32)
+      input_signature = (input_sd, input_sd)
+      n_layers = 2
+      def build(scan_layers):
+        return reformer.Reformer(
+            16, d_model=32, d_ff=64, n_encoder_layers=n_layers,
+            n_decoder_layers=n_layers, n_heads=2, dropout=0.0, max_len=16,
+            scan_layers=scan_layers)
+      unrolled_model = build(False)
+      scanned_model = build(True)
+      weights, state = unrolled_model.init(input_signature)
+      scanned_model.init(input_signature)
+
+      # Stack the per-layer weights (and state) of each reversible stack the
+      # way ScannedReversibleSerial stores them.
+      stack_indices = [i for i, layer in enumerate(unrolled_model.sublayers)
+                       if isinstance(layer, tl.ReversibleSerial)]
+      def to_scanned(tree):
+        tree = list(tree)
+        for i in stack_indices:
+          block_size = len(tree[i]) // n_layers
+          blocks = [tree[i][j:j + block_size]
+                    for j in range(0, len(tree[i]), block_size)]
+          tree[i] = [jax.tree_util.tree_multimap(
+              lambda *xs: np.stack(xs), *blocks)]
+        return tree
+      scanned_weights, scanned_state = to_scanned(weights), to_scanned(state)
+
+      inputs = tuple(onp.random.randint(1, 16, size=(1, 8)).astype(onp.int32)
+                     for _ in range(2))
+      rng = math.random.get_prng(0)
+      def loss_and_grads(model, weights, state):
+        def loss(weights):
+          output = model(inputs, weights=weights, state=state, rng=rng)
+          return np.sum(output[0] * output[0])
+        return loss(weights), math.grad(loss)(weights)
+
+      expected_loss, expected_grads = loss_and_grads(
+          unrolled_model, weights, state)
+      scanned_loss, scanned_grads = loss_and_grads(
+          scanned_model, scanned_weights, scanned_state)
+      onp.testing.assert_allclose(scanned_loss, expected_loss, rtol=1e-5)
+      for expected, grad in zip(
+          jax.tree_util.tree_leaves(to_scanned(expected_grads)),
+          jax.tree_util.tree_leaves(scanned_grads)):
+        onp.testing.assert_allclose(grad, expected, rtol=1e-4, atol=1e-5)
+
+  def test_reformer_fused_loss_matches_cross_entropy_loss(self):
+    with math.use_backend('jax'):
+      tokens_sd = ShapeDtype((2, 8), np.int32)
+      input_signature = (tokens_sd, tokens_sd, ShapeDtype((2, 8)))
+      def build(fused_loss, mode):
+        return reformer.Reformer(
+            16, d_model=32, d_ff=64, n_encoder_layers=1, n_decoder_layers=1,
+            n_heads=2, dropout=0.0, max_len=16, fused_loss=fused_loss,
+            n_vocab_tiles=4 if fused_loss else 1, mode=mode)
+      standard = tl.Serial(
+          build(False, 'train'),
+          tl.CrossEntropyLoss(id_to_mask=0, has_weights=True))
+      fused = tl.Serial(
+          build(True, 'train'),
+          tl.NegLogProbLoss(id_to_mask=0, has_weights=True))
+      weights, state = standard.init(input_signature)
+      fused.init(input_signature)
+
+      # The fused head stores the Dense weights and has no LogSoftmax layer.
+      def to_fused(tree):
+        return (tuple(tree[0][:-1]), tree[1])
+      fused_weights, fused_state = to_fused(weights), to_fused(state)
+
+      tokens = onp.random.randint(1, 16, size=(2, 8)).astype(onp.int32)
+      targets = onp.random.randint(1, 16, size=(2, 8)).astype(onp.int32)
+      targets[:, 6:] = 0  # Padding, masked out by id_to_mask.
+      loss_weights = onp.random.uniform(size=(2, 8)).astype(onp.float32)
+      inputs = (tokens, targets, loss_weights)
+      rng = math.random.get_prng(0)
+      def loss_and_grads(model, weights, state):
+        def loss(weights):
+          return model(inputs, weights=weights, state=state, rng=rng)
+        return loss(weights), math.grad(loss)(weights)
+
+      expected_loss, expected_grads = loss_and_grads(standard, weights, state)
+      fused_loss, fused_grads = loss_and_grads(
+          fused, fused_weights, fused_state)
+      onp.testing.assert_allclose(fused_loss, expected_loss, rtol=1e-5)
+      for expected, grad in zip(
+          jax.tree_util.tree_leaves(to_fused(expected_grads)),
+          jax.tree_util.tree_leaves(fused_grads)):
+        onp.testing.assert_allclose(grad, expected, rtol=1e-4, atol=1e-5)
+
+      # In eval mode the fused model reads the same weights and outputs
+      # log-probabilities.
+      standard_eval, fused_eval = build(False, 'eval'), build(True, 'eval')
+      standard_eval.init(input_signature[:2])
+      fused_eval.init(input_signature[:2])
+      expected_log_probs = standard_eval(
+          inputs[:2], weights=weights[0], state=state[0], rng=rng)[0]
+      log_probs = fused_eval(
+          inputs[:2], weights=fused_weights[0], state=fused_state[0],
+          rng=rng)[0]
+      onp.testing.assert_allclose(
+          log_probs, expected_log_probs, rtol=1e-5, atol=1e-5)
+
+  @parameterized.named_parameters(('unrolled', False), ('scanned', True))
+  def test_reformer_grad_with_bool_masks(self, scan_layers):
+    with math.use_backend('jax'):
+      # pylint: disable=protected-access
+      check_inexact_input_vjp = jax.api._check_inexact_input_vjp
+      input_sd = ShapeDtype((2, 8), np.int32)
+      model = reformer.Reformer(
+          16, d_model=32, d_ff=64, n_encoder_layers=2, n_decoder_layers=2,
+          n_heads=2, max_len=16, scan_layers=scan_layers)
+      weights, state = model.init((input_sd, input_sd))
+      # Trailing zeros are padding, so the masks are not all True.
+      tokens = onp.random.randint(1, 16, size=(2, 8)).astype(onp.int32)
+      tokens[:, 6:] = 0
+      rng = math.random.get_prng(0)
+      def loss(weights):
+        output = model((tokens, tokens), weights=weights, state=state, rng=rng)
+        return np.sum(output[0])
+      grads = math.grad(loss)(weights)
+
+      self.assertIs(check_inexact_input_vjp,
+                    jax.api._check_inexact_input_vjp)
+      # pylint: enable=protected-access
+      leaves = jax.tree_util.tree_leaves(grads)
+      for grad in leaves:
+        self.assertTrue(onp.all(onp.isfinite(grad)))
+      self.assertTrue(any(onp.any(grad != 0) for grad in leaves))
+
+  def test_reformer_shares_positional_encoding(self):
+    input_sd = ShapeDtype((1, 8), np.int32)
+    model = reformer.Reformer(
+        16, output_vocab_size=20, d_model=32, d_ff=64, n_encoder_layers=1,
+        n_decoder_layers=1, n_heads=2, max_len=16)
+    weights, _ = model.init((input_sd, input_sd))
+    tables = [w for w in jax.tree_util.tree_leaves(weights)
+              if w.shape == (1, 16, 32)]
+    self.assertLen(tables, 1)
+
+  def test_wrapped_layers_get_their_own_rngs(self):
+    layer = tl.Serial(
+        reformer.MixedPrecision(tl.Dense(4), onp.float32),
+        reformer.Remat(tl.Dense(4)),
+    )
+    weights, _ = layer.init(ShapeDtype((2, 4)))
+    (w1, _), (w2, _) = weights
+    self.assertFalse(onp.allclose(w1, w2))
+
+  def test_wrapped_layer_is_a_sublayer(self):
+    dense = tl.Dense(4)
+    layer = reformer.Map(reformer.MixedPrecision(dense, onp.float32))
+    layer.init(ShapeDtype((2, 4)))
+    self.assertIs(dense, layer.sublayers[0].sublayers[0])
+    self.assertIn('Dense', repr(layer))
+    w, b = layer.weights
+    layer.weights = (w + 1.0, b)
+    onp.testing.assert_allclose(dense.weights[0], w + 1.0)
+
+  def test_map_does_not_leak_tracers(self):
+    dropout = tl.Dropout(rate=0.5, mode='train')
+    layer = reformer.Map(tl.Serial(dropout), n_sections=2)
+    x = onp.ones((2, 4), dtype=onp.float32)
+    layer.init((ShapeDtype(x.shape), ShapeDtype(x.shape)))
+    layer((x, x), rng=math.random.get_prng(0))
+    for leaf in jax.tree_util.tree_leaves(dropout.state):
+      self.assertNotIsInstance(leaf, jax.core.Tracer)
+
+  def test_split_for_output_reverse(self):
+    layer = reformer.SplitForOutput(n_sections=2, axis=-2)
+    x1 = onp.random.uniform(size=(2, 8, 3)).astype(onp.float32)
+    x2 = onp.random.uniform(size=(2, 8, 3)).astype(onp.float32)
+    ys = layer.forward((x1, x2), ())
+    self.assertEqual(((2, 4, 6), (2, 4, 6)), tuple(y.shape for y in ys))
+    onp.testing.assert_allclose(ys[1][:, :, :3], x1[:, 4:])
+    onp.testing.assert_allclose(ys[0][:, :, 3:], x2[:, :4])
+    rx1, rx2 = layer.reverse(ys)
+    onp.testing.assert_allclose(rx1, x1)
+    onp.testing.assert_allclose(rx2, x2)
+    (rx1, rx2), ((gx1, gx2), _) = layer.reverse_and_grad(ys, ys)
+    for x, y in [(x1, rx1), (x2, rx2), (x1, gx1), (x2, gx2)]:
+      onp.testing.assert_allclose(y, x)
+
+  def test_apply_residual_matches_select_and_add(self):
+    x2, x1, residual = (onp.random.uniform(size=(2, 4)).astype(onp.float32)
+                        for _ in range(3))
+    for subtract, combine in [(False, tl.Add()), (True, tl.SubtractTop())]:
+      layer = reformer.ApplyResidual(subtract=subtract)  # pylint: disable=no-value-for-parameter
+      expected_layer = tl.Serial(tl.Select([2, 1, 0]), tl.Parallel(combine, []))
+      ys = layer((x2, x1, residual))
+      expected_layer.init((ShapeDtype((2, 4)),) * 3)
+      for y, expected in zip(ys, expected_layer((x2, x1, residual))):
+        onp.testing.assert_allclose(y, expected)
+
+  def test_decoder_block_chunked_attention_matches_unchunked(self):
+    with math.use_backend('jax'):
+      def build(n_attention_chunks):
+        return tl.ReversibleSerial(reformer.DecoderBlock(
+            32, 64, 16, 16, 2, n_attention_chunks,
+            tl.DotProductCausalAttention, 0.0, False, tl.Relu, 0, 0, 'eval'))
+      chunked, unchunked = build(2), build(1)
+      weights, state = unchunked.init(
+          (ShapeDtype((2, 4, 32)), ShapeDtype((2, 4, 32))))
+      chunked.init((ShapeDtype((2, 8, 32)), ShapeDtype((2, 8, 32))))
+
+      # With two attention chunks, each half of the sequence attends only
+      # to itself, exactly as if the unchunked block ran on each half.
+      x = tuple(onp.random.uniform(size=(2, 8, 32)).astype(onp.float32)
+                for _ in range(2))
+      rng = math.random.get_prng(0)
+      ys = chunked(x, weights=weights, state=state, rng=rng)
+      halves = [unchunked(tuple(xi[:, i:i + 4] for xi in x), weights=weights,
+                          state=state, rng=rng) for i in (0, 4)]
+      for y, first, second in zip(ys, *halves):
+        onp.testing.assert_allclose(
+            y, onp.concatenate([first, second], axis=1), rtol=1e-5,
+            atol=1e-5)
+
+  def test_chunked_layer_norm(self):
+    layer = reformer.ChunkedLayerNorm(n_sections=2)
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    layer.init(ShapeDtype(x.shape))
+    expected = tl.Serial(tl.LayerNorm(), reformer.Chunk(n_sections=2))  # pylint: disable=no-value-for-parameter
+    expected.init(ShapeDtype(x.shape))
+    onp.testing.assert_allclose(layer(x), expected(x), rtol=1e-5)
+
+  def test_layer_norm_qkv(self):
+    layer = reformer.LayerNormQKV(8, n_heads=2)
+    final_shape = tl.check_shape_agreement(layer, ShapeDtype((2, 4, 16)))
+    self.assertEqual(((4, 4, 4),) * 3, final_shape)
+
+    layer = reformer.LayerNormQKV(8)
+    tl.check_shape_agreement(layer, ShapeDtype((2, 4, 16)))
+    _, w, b = layer.weights
+    x = onp.random.uniform(size=(2, 4, 16)).astype(onp.float32)
+    normalized = (x - x.mean(-1, keepdims=True)) / onp.sqrt(
+        x.var(-1, keepdims=True) + 1e-6)
+    q, k, v = layer(x)
+    for i, y in enumerate([q, k, v]):
+      part = slice(i * 8, (i + 1) * 8)
+      expected = onp.dot(normalized, w[:, part]) + b[part]
+      onp.testing.assert_allclose(y, expected, rtol=1e-4, atol=1e-5)
+
+  def test_gated_feed_forward(self):
+    layer = tl.Serial(reformer.GatedFeedForward(
+        16, 32, dropout=0.0, activation=tl.Relu, mode='eval'))
+    weights, state = layer.init(ShapeDtype((2, 8, 16)))
+    (scale, bias), (w1, b1), (w2, b2) = weights[0], weights[1], weights[-2]
+
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    normalized = (x - x.mean(-1, keepdims=True)) / onp.sqrt(
+        x.var(-1, keepdims=True) + 1e-6) * scale + bias
+    hidden = onp.dot(normalized, w1) + b1
+    gated = onp.maximum(hidden[..., :32], 0.0) * hidden[..., 32:]
+    expected = onp.dot(gated, w2) + b2
+    y = layer(x, weights=weights, state=state, rng=math.random.get_prng(0))
+    onp.testing.assert_allclose(y, expected, rtol=1e-4, atol=1e-5)
+
+  def test_tiled_feed_forward_matches_feed_forward(self):
+    input_signature = ShapeDtype((2, 8, 16))
+    layer = reformer.TiledFeedForward(
+        16, 32, dropout=0.0, activation=tl.Relu, n_tiles=4, mode='eval')
+    # FeedForward without its leading LayerNorm.
+    expected_layer = tl.Serial(reformer.FeedForward(
+        16, 32, dropout=0.0, activation=tl.Relu, mode='eval')[1:])
+    w1, b1, w2, b2 = layer.init(input_signature)[0]
+    _, expected_state = expected_layer.init(input_signature)
+
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    rng = math.random.get_prng(0)
+    expected = expected_layer(
+        x, weights=((w1, b1), (), (), (w2, b2), ()), state=expected_state,
+        rng=rng)
+    onp.testing.assert_allclose(
+        layer(x, rng=rng), expected, rtol=1e-5, atol=1e-5)
+
+  def test_single_tile_chunked_feed_forward_matches_feed_forward(self):
+    input_signature = ShapeDtype((2, 8, 16))
+    chunked = tl.Serial(reformer.ChunkedFeedForward(
+        16, 32, dropout=0.0, activation=tl.Relu, chunk_size=4, mode='eval'))
+    plain = tl.Serial(reformer.FeedForward(
+        16, 32, dropout=0.0, activation=tl.Relu, mode='eval'))
+    weights, state = chunked.init(input_signature)
+    plain.init(input_signature)
+
+    # Without tiling, the chunked block keeps the FeedForward weight layout.
+    (ff_weights,), (ff_state,) = weights, state
+    self.assertEqual(
+        jax.tree_util.tree_structure(plain.weights),
+        jax.tree_util.tree_structure(ff_weights))
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    rng = math.random.get_prng(0)
+    onp.testing.assert_allclose(
+        chunked(x, weights=weights, state=state, rng=rng),
+        plain(x, weights=ff_weights, state=ff_state, rng=rng),
+        rtol=1e-5, atol=1e-5)
+
+  def test_apply_in_chunks_splits_rng_per_chunk(self):
+    layer = reformer.ApplyInChunks(tl.Dropout(rate=0.5, mode='train'), 4)
+    x = onp.ones((2, 8, 16), onp.float32)
+    weights, state = layer.init(ShapeDtype(x.shape))
+    y = layer(x, weights=weights, state=state, rng=math.random.get_prng(0))
+    self.assertEqual(x.shape, y.shape)
+    masks = onp.reshape(onp.asarray(y) > 0, (4, 4, 16))
+    for i in range(1, 4):
+      self.assertFalse(onp.array_equal(masks[0], masks[i]))
+
+  @parameterized.named_parameters(('single_tile', 1), ('four_tiles', 4))
+  def test_tiled_log_softmax_dense(self, n_tiles):
+    layer = reformer.TiledLogSoftmaxDense(10, n_tiles=n_tiles)
+    final_shape = tl.check_shape_agreement(layer, ShapeDtype((2, 8, 16)))
+    self.assertEqual((2, 8, 10), final_shape)
+
+    w, b = layer.weights
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    logits = onp.dot(x, w) + b
+    expected = logits - math.logsumexp(logits, -1, keepdims=True)
+    onp.testing.assert_allclose(layer(x), expected, rtol=1e-5, atol=1e-5)
+
+  @parameterized.named_parameters(('single_tile', 1), ('five_tiles', 5))
+  def test_tiled_log_softmax_cross_entropy(self, n_tiles):
+    layer = reformer.TiledLogSoftmaxCrossEntropy(10, n_tiles=n_tiles)
+    input_signature = (ShapeDtype((2, 8, 16)), ShapeDtype((2, 8), np.int32))
+    weights, _ = layer.init(input_signature)
+
+    w, b = weights
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    targets = onp.random.randint(10, size=(2, 8)).astype(onp.int32)
+    logits = onp.dot(x, w) + b
+    log_probs = logits - math.logsumexp(logits, -1, keepdims=True)
+    expected = -onp.take_along_axis(
+        onp.asarray(log_probs), targets[..., None], -1)[..., 0]
+    onp.testing.assert_allclose(
+        layer((x, targets)), expected, rtol=1e-5, atol=1e-5)
+
+  def test_low_precision_positional_encoding(self):
+    layer = reformer.LowPrecisionPositionalEncoding(max_len=16, mode='eval')
+    x = onp.random.uniform(size=(2, 8, 32)).astype(onp.float32)
+    layer.init(ShapeDtype(x.shape))
+    self.assertEqual(jax.numpy.bfloat16, layer.weights.dtype)
+
+    y = layer(x)
+    self.assertEqual(onp.float32, y.dtype)
+    expected = tl.PositionalEncoding(max_len=16, mode='eval')
+    expected.init(ShapeDtype(x.shape))
+    onp.testing.assert_allclose(y, expected(x), atol=1e-2)
+
+  def test_fused_embed_pos_dropout_matches_embedding_and_encoding(self):
+    layer = reformer.FusedEmbedPosDropout(10, 16, max_len=32, mode='eval')
+    expected_layer = tl.Serial(
+        tl.Embedding(16, 10), tl.PositionalEncoding(max_len=32, mode='eval'))
+    input_signature = ShapeDtype((2, 8), np.int32)
+    weights, state = layer.init(input_signature)
+    expected_layer.init(input_signature)
+
+    x = onp.random.randint(10, size=(2, 8)).astype(onp.int32)
+    rng = math.random.get_prng(0)
+    y = layer(x, weights=weights, state=state, rng=rng)
+    expected = expected_layer(x, weights=list(weights), rng=rng)
+    onp.testing.assert_allclose(y, expected, rtol=1e-6)
+
+  def test_reformer_lm_fuse_embedding(self):
+    input_sd = ShapeDtype((1, 8), np.int32)
+    def build(fuse_embedding):
+      return reformer.ReformerLM(
+          16, d_model=32, d_ff=64, d_attention_key=16, d_attention_value=16,
+          n_layers=1, n_heads=2, dropout=0.0, max_len=16,
+          fuse_embedding=fuse_embedding, mode='eval')
+    model, fused_model = build(False), build(True)
+    weights, state = model.init(input_sd)
+    fused_model.init(input_sd)
+
+    # Unfused, ShiftRight is followed by Embedding, dropout and
+    # PositionalEncoding; fused, by a single layer holding both tables.
+    fused_weights = [weights[0], (weights[1], weights[3])] + list(weights[4:])
+    fused_state = [state[0], state[3]] + list(state[4:])
+    tokens = onp.random.randint(16, size=(1, 8)).astype(onp.int32)
+    rng = math.random.get_prng(0)
+    onp.testing.assert_allclose(
+        fused_model(tokens, weights=fused_weights, state=fused_state, rng=rng),
+        model(tokens, weights=weights, state=state, rng=rng),
+        rtol=1e-5, atol=1e-5)
+
+  def test_shifted_embedding_matches_shift_right_and_embedding(self):
+    layer = reformer.ShiftedEmbedding(tl.Embedding(16, 10))
+    expected_layer = tl.Serial(tl.ShiftRight(), tl.Embedding(16, 10))
+    input_signature = ShapeDtype((2, 8), np.int32)
+    weights, _ = layer.init(input_signature)
+    expected_layer.init(input_signature)
+
+    x = onp.random.randint(10, size=(2, 8)).astype(onp.int32)
+    onp.testing.assert_allclose(
+        layer(x), expected_layer(x, weights=((), weights)))
+
+  def test_embed_and_mask_matches_branch(self):
+    layer = reformer.EmbedAndMask(tl.Embedding(16, 10))
+    expected_layer = tl.Branch(tl.Embedding(16, 10), tl.PaddingMask())
+    input_signature = ShapeDtype((2, 8), np.int32)
+    weights, _ = layer.init(input_signature)
+    expected_layer.init(input_signature)
+
+    x = onp.random.randint(10, size=(2, 8)).astype(onp.int32)
+    embedded, mask = layer(x)
+    expected_embedded, expected_mask = expected_layer(
+        x, weights=((), (weights, ())))
+    onp.testing.assert_allclose(embedded, expected_embedded)
+    onp.testing.assert_array_equal(mask, expected_mask)
+
+  def test_mask_and_dup(self):
+    layer = reformer.MaskAndDup()  # pylint: disable=no-value-for-parameter
+    x = onp.random.uniform(size=(2, 8, 16)).astype(onp.float32)
+    padding_mask = onp.random.randint(2, size=(2, 1, 1, 6)).astype(onp.bool_)
+    x1, x2, mask = layer((x, padding_mask))
+    expected = tl.Serial(
+        tl.Branch([], tl.EncoderDecoderMask()), tl.Dup())
+    expected.init((ShapeDtype(x.shape), ShapeDtype((2, 1, 1, 6), onp.bool_)))
+    e1, e2, expected_mask = expected((x, padding_mask))
+    onp.testing.assert_allclose(x1, e1)
+    onp.testing.assert_allclose(x2, e2)
+    onp.testing.assert_allclose(mask, expected_mask)
+    self.assertEqual((2, 1, 8, 6), mask.shape)
+
+  def test_int8_embedding_matches_dequantized_table(self):
+    layer = reformer.Int8Embedding(16, 10)
+    layer.init(ShapeDtype((2, 8), np.int32))
+
+    table = onp.random.normal(size=(10, 16)).astype(onp.float32)
+    quantized, scales = reformer.quantize_embedding(table)
+    layer.weights = (quantized, scales)
+    dequantized = (onp.asarray(quantized, onp.float32) *
+                   onp.asarray(scales, onp.float32))
+    x = onp.random.randint(10, size=(2, 8)).astype(onp.int32)
+    y = layer(x)
+    onp.testing.assert_allclose(y, dequantized[x])
+    onp.testing.assert_allclose(y, table[x], atol=0.05)
+
   def test_reformer_rng_consistency(self):
     with math.use_backend('jax'):
       vocab_size = 16
@@ -103,6 +784,33 @@ class ReformerTest(parameterized.TestCase):
       for grad in jax.tree_util.tree_leaves(grads):
         assert onp.all(onp.isfinite(grad))
 
+  def test_apply_attention_wrapper_matches_parallel(self):
+    with math.use_backend('jax'):
+      attention = PoisonOnRNGMismatchAttention(mode='train')
+      layer = reformer.ApplyAttentionWrapper(attention)
+      expected_layer = tl.Parallel(
+          PoisonOnRNGMismatchAttention(mode='train'), [], [])
+      input_signature = tuple(
+          ShapeDtype((2, 4, 8)) for _ in range(layer.n_in))
+      weights, state = layer.init(input_signature)
+      expected_layer.init(input_signature)
+
+      x = tuple(onp.random.uniform(size=(2, 4, 8)).astype(onp.float32)
+                for _ in range(layer.n_in))
+      rng = math.random.get_prng(0)
+      outputs, new_state = layer.forward_with_state(
+          x, weights, state, rng=rng)
+      expected_outputs, expected_state = expected_layer.forward_with_state(
+          x, weights, state, rng=rng)
+      # The attention passes its values through and returns its rng as state,
+      # so this also checks that it gets the same rng as under tl.Parallel.
+      for actual, expected in zip(
+          jax.tree_util.tree_leaves((outputs, new_state)),
+          jax.tree_util.tree_leaves((expected_outputs, expected_state))):
+        onp.testing.assert_array_equal(actual, expected)
+      # Nothing from the call is cached on the attention layer.
+      onp.testing.assert_array_equal(state[0], attention.state)
+
 
 if __name__ == '__main__':
   absltest.main()